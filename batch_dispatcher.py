@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchDispatcher:
+    def __init__(self, service, window=0.05, max_batch=50):
+        """
+        Collects API requests submitted by many sessions for up to
+        `window` seconds and sends them together through the API's HTTP
+        batch endpoint, handing each response back to the session that
+        submitted the request. All requests must be for the same API as
+        the service.
+        """
+        self.service = service
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(
+            target=self.run_worker, name="batch-dispatcher", daemon=True
+        )
+        self.worker.start()
+
+    def submit(self, request):
+        """
+        Queues a request for the next batch and returns a future for
+        its response
+        """
+        future = Future()
+        self.pending.put((request, future))
+        return future
+
+    def run_worker(self):
+        """
+        Sends a batch whenever the coalescing window after the first
+        queued request closes or the batch is full
+        """
+        while True:
+            batch = [self.pending.get()]
+            send_at = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = send_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.send(batch)
+
+    def send(self, batch):
+        """
+        Executes a batch of (request, future) pairs and resolves each
+        future with its own response or error. Requests whose futures
+        were cancelled while queued are left out.
+        """
+        batch = [
+            (request, future)
+            for request, future in batch
+            if future.set_running_or_notify_cancel()
+        ]
+        if not batch:
+            return
+        if len(batch) == 1:
+            request, future = batch[0]
+            try:
+                future.set_result(request.execute())
+            except Exception as error:
+                future.set_exception(error)
+            return
+        futures = {}
+
+        def resolve(request_id, response, exception):
+            if exception is None:
+                futures[request_id].set_result(response)
+            else:
+                futures[request_id].set_exception(exception)
+
+        http_batch = self.service.new_batch_http_request(callback=resolve)
+        for number, (request, future) in enumerate(batch):
+            futures[str(number)] = future
+            http_batch.add(request, request_id=str(number))
+        try:
+            http_batch.execute()
+        except Exception as error:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(error)
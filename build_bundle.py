@@ -0,0 +1,408 @@
+"""
+Builds the Travel Budget Planner into one self-contained zipapp,
+dist/travel_budget.pyz, for hosts where sessions start from a cold file
+cache. The archive holds the app's modules and those of every package
+in requirements.txt as precompiled bytecode, together with intro.txt
+and the discovery documents of the Google APIs the app uses. Starting
+a session then reads one file rather than searching site-packages and
+compiling the app's modules.
+
+Packages with compiled extensions cannot be imported from an archive.
+They are kept in an archive of their own inside the bundle, so that
+zipimport has fewer entries to index at startup, and extracted to a
+cache directory, once per build, the first time the bundle runs.
+
+Build it with the Python version that will run it, e.g.
+    python3 build_bundle.py
+and start a session, the session server or the zygote with
+    python3 -S dist/travel_budget.pyz
+    python3 -S dist/travel_budget.pyz session_server --port 8700
+    python3 -S dist/travel_budget.pyz session_zygote --port 8700
+"""
+import argparse
+import glob
+import hashlib
+import importlib.metadata
+import importlib.util
+import os
+import py_compile
+import re
+import shutil
+import sys
+import tempfile
+import warnings
+import zipapp
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLE_PATH = os.path.join("dist", "travel_budget.pyz")
+REQUIREMENTS_FILE = "requirements.txt"
+INTERPRETER = "/usr/bin/env python3"
+
+APP_DATA = ["intro.txt"]
+
+BUILD_ONLY = ["build_bundle.py", "startup_bench.py", "fake_google.py"]
+"""
+Modules in the app's directory that are left out of the bundle
+"""
+
+DISCOVERY_DIR = "googleapiclient/discovery_cache/documents/"
+DISCOVERY_DOCUMENTS = ["docs.v1.json", "drive.v3.json"]
+"""
+Discovery documents of the APIs that google_services.py builds clients
+for. The hundreds of others shipped with googleapiclient are left out.
+"""
+
+DIST_INFO_FILES = ["METADATA", "entry_points.txt", "top_level.txt"]
+"""
+Files kept from each package's .dist-info directory, which are all
+importlib.metadata reads to find versions and entry points
+"""
+
+ON_DISK = ["certifi"]
+"""
+Packages without compiled extensions that still have to be extracted,
+because they hand out paths to their files. certifi's CA bundle would
+otherwise be copied to a temporary file by every process.
+"""
+
+SKIPPED_SUFFIXES = (".pyc", ".pyi", ".proto", "py.typed")
+"""
+Files that are never read at run time: stale bytecode, type stubs and
+protocol buffer sources, whose compiled modules are bundled instead
+"""
+
+NATIVE_DIR = "_native"
+NATIVE_ARCHIVE = "_native.zip"
+"""
+Archive in the bundle of the packages that are extracted, staged in
+NATIVE_DIR
+"""
+
+ENTRY_POINTS = ["run", "session_server", "session_zygote"]
+"""
+Modules whose main() the bundle can start. The first is the default.
+"""
+
+MAIN_TEMPLATE = '''"""
+Starts the Travel Budget Planner from its zipapp bundle, built by
+build_bundle.py
+"""
+import importlib
+import importlib.util
+import os
+import sys
+
+
+BUILD_ID = @BUILD_ID@
+MAGIC_NUMBER = @MAGIC_NUMBER@
+NATIVE_ARCHIVE = @NATIVE_ARCHIVE@
+ENTRY_POINTS = @ENTRY_POINTS@
+
+CACHE_DIR = os.environ.get(
+    "TRAVEL_BUDGET_BUNDLE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "travel_budget"),
+)
+"""
+Directory the packages with compiled extensions are extracted to
+"""
+
+
+def extract_native(archive):
+    """
+    Extracts the packages that cannot be imported from the archive, if
+    this build has not done so already, and returns their directory
+    """
+    target = os.path.join(CACHE_DIR, BUILD_ID)
+    if os.path.isdir(target):
+        return target
+    import io
+    import shutil
+    import zipfile
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_dir = f"{target}.{os.getpid()}.tmp"
+    with zipfile.ZipFile(archive) as bundle:
+        native = io.BytesIO(bundle.read(NATIVE_ARCHIVE))
+    with zipfile.ZipFile(native) as packages:
+        packages.extractall(temp_dir)
+    try:
+        os.rename(temp_dir, target)
+    except OSError:
+        # Another process extracted it first.
+        pass
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return target
+
+
+def main():
+    if importlib.util.MAGIC_NUMBER != MAGIC_NUMBER:
+        sys.exit(
+            "This bundle was built for another version of Python. "
+            "Rebuild it with build_bundle.py."
+        )
+    archive = os.path.dirname(os.path.abspath(__file__))
+    if not sys.flags.no_site:
+        # Only the bundle's own copies of packages are imported.
+        import site
+        installed = site.getsitepackages() + [site.getusersitepackages()]
+        sys.path[:] = [path for path in sys.path if path not in installed]
+    sys.path.append(extract_native(archive))
+    name = ENTRY_POINTS[0]
+    if len(sys.argv) > 1 and sys.argv[1] in ENTRY_POINTS:
+        name = sys.argv.pop(1)
+    importlib.import_module(name).main()
+
+
+main()
+'''
+
+
+def requirement_name(requirement):
+    """ Returns the distribution name a requirement line refers to. """
+    return re.split(r"[\s;<>=!~\[(]", requirement.strip(), maxsplit=1)[0]
+
+
+def normalized(name):
+    """ Returns a distribution name in its normalized form. """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def resolve_distributions(names):
+    """
+    Returns the installed distributions of the named requirements and
+    of everything they require, leaving out optional extras
+    """
+    distributions = {}
+    pending = [(name, True) for name in names]
+    while pending:
+        name, top_level = pending.pop()
+        if normalized(name) in distributions:
+            continue
+        try:
+            distribution = importlib.metadata.distribution(name)
+        except importlib.metadata.PackageNotFoundError:
+            # A dependency that is not installed was excluded by its
+            # environment marker.
+            if top_level:
+                print(f"{name} is not installed and is left out")
+            continue
+        distributions[normalized(name)] = distribution
+        for requirement in distribution.requires or []:
+            if "extra ==" not in requirement:
+                pending.append((requirement_name(requirement), False))
+    return sorted(
+        distributions.values(), key=lambda item: normalized(item.name)
+    )
+
+
+def read_requirements(path):
+    """ Returns the names of the requirements in a requirements file. """
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.split("#")[0].strip() for line in f]
+    return [requirement_name(line) for line in lines if line]
+
+
+def is_native(distribution):
+    """
+    Returns whether a distribution has to be extracted to be imported
+    """
+    if normalized(distribution.name) in map(normalized, ON_DISK):
+        return True
+    return any(
+        str(file).endswith((".so", ".pyd"))
+        for file in distribution.files or []
+    )
+
+
+def bundled_files(distribution):
+    """
+    Returns the path in the archive and on disk of each of a
+    distribution's files that belongs in the bundle
+    """
+    files = []
+    for file in distribution.files or []:
+        name = file.as_posix()
+        if name.startswith("..") or "__pycache__" in file.parts:
+            continue
+        if name.endswith(SKIPPED_SUFFIXES):
+            continue
+        if (
+            file.parts[0].endswith(".dist-info")
+            and file.name not in DIST_INFO_FILES
+        ):
+            continue
+        if (
+            name.startswith(DISCOVERY_DIR)
+            and name[len(DISCOVERY_DIR):] not in DISCOVERY_DOCUMENTS
+        ):
+            continue
+        path = str(distribution.locate_file(file))
+        if os.path.isfile(path):
+            files.append((name, path))
+    return files
+
+
+class Staging:
+    def __init__(self, directory):
+        """
+        The directory the archive's contents are gathered in. Keeps a
+        hash of everything added, which identifies the build.
+        """
+        self.directory = directory
+        self.hash = hashlib.sha256()
+        self.count = 0
+
+    def target(self, name):
+        """ Returns the path in the directory of a file in the archive. """
+        path = os.path.join(self.directory, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def record(self, name):
+        """ Adds a file that has been written to the build's hash. """
+        self.hash.update(name.encode("utf-8"))
+        with open(self.target(name), "rb") as f:
+            self.hash.update(f.read())
+        self.count += 1
+
+    def copy(self, name, source):
+        """ Adds a file to the archive as it is. """
+        shutil.copyfile(source, self.target(name))
+        self.record(name)
+
+    def compile(self, name, source):
+        """
+        Adds a module to the archive as bytecode under name. The
+        bytecode is never checked against a source, so it loads as it
+        is wherever it ends up. A module that does not compile is added
+        as source, so it fails on import as it would anyway.
+        """
+        try:
+            py_compile.compile(
+                source,
+                cfile=self.target(name),
+                dfile=name,
+                doraise=True,
+                invalidation_mode=(
+                    py_compile.PycInvalidationMode.UNCHECKED_HASH
+                ),
+            )
+        except py_compile.PyCompileError:
+            self.copy(name[:-1], source)
+            return
+        self.record(name)
+
+    def add_module(self, name, source):
+        """
+        Adds a module to be imported from the archive. Only the
+        bytecode is added, next to where the source would be, which
+        zipimport loads directly.
+        """
+        self.compile(f"{name}c", source)
+
+    def add_extracted_module(self, name, source):
+        """
+        Adds a module to be imported once extracted, with its bytecode
+        where the import system caches it
+        """
+        self.copy(name, source)
+        self.compile(importlib.util.cache_from_source(name), source)
+
+    def build_id(self):
+        """ Returns an ID that changes whenever the contents do. """
+        return self.hash.hexdigest()[:16]
+
+
+def stage_distribution(staging, distribution):
+    """ Adds a distribution's modules and data files. """
+    native = is_native(distribution)
+    for name, path in bundled_files(distribution):
+        if native:
+            name = f"{NATIVE_DIR}/{name}"
+            if name.endswith(".py"):
+                staging.add_extracted_module(name, path)
+            else:
+                staging.copy(name, path)
+        elif name.endswith(".py"):
+            staging.add_module(name, path)
+        else:
+            staging.copy(name, path)
+
+
+def stage_app(staging):
+    """ Adds the app's own modules and data files. """
+    for path in sorted(glob.glob(os.path.join(APP_DIR, "*.py"))):
+        name = os.path.basename(path)
+        # Scripts such as get-pip.py are not importable modules.
+        if name not in BUILD_ONLY and name[:-3].isidentifier():
+            staging.add_module(name, path)
+    for name in APP_DATA:
+        staging.copy(name, os.path.join(APP_DIR, name))
+
+
+def main_source(build_id):
+    """ Returns the source of the archive's __main__.py. """
+    values = {
+        "@BUILD_ID@": repr(build_id),
+        "@MAGIC_NUMBER@": repr(importlib.util.MAGIC_NUMBER),
+        "@NATIVE_ARCHIVE@": repr(NATIVE_ARCHIVE),
+        "@ENTRY_POINTS@": repr(ENTRY_POINTS),
+    }
+    source = MAIN_TEMPLATE
+    for placeholder, value in values.items():
+        source = source.replace(placeholder, value)
+    return source
+
+
+def build(output=BUNDLE_PATH, requirements=REQUIREMENTS_FILE):
+    """
+    Builds the bundle and returns the number of files in it and the
+    build ID
+    """
+    distributions = resolve_distributions(
+        read_requirements(os.path.join(APP_DIR, requirements))
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        staging = Staging(directory)
+        with warnings.catch_warnings():
+            # Invalid escape sequences and the like in dependencies.
+            warnings.simplefilter("ignore")
+            for distribution in distributions:
+                stage_distribution(staging, distribution)
+            stage_app(staging)
+        build_id = staging.build_id()
+        native_dir = staging.target(NATIVE_DIR)
+        os.makedirs(native_dir, exist_ok=True)
+        shutil.make_archive(
+            os.path.splitext(staging.target(NATIVE_ARCHIVE))[0],
+            "zip",
+            native_dir,
+        )
+        shutil.rmtree(native_dir)
+        with open(staging.target("__main__.py"), "w", encoding="utf-8") as f:
+            f.write(main_source(build_id))
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        zipapp.create_archive(
+            directory, output, interpreter=INTERPRETER, compressed=True
+        )
+    return staging.count + 1, build_id
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--output", default=BUNDLE_PATH)
+    parser.add_argument("--requirements", default=REQUIREMENTS_FILE)
+    args = parser.parse_args()
+    count, build_id = build(args.output, args.requirements)
+    size = os.path.getsize(args.output)
+    print(
+        f"Built {args.output}: {count} files, {size / 1e6:.1f} MB, "
+        f"build {build_id} for Python {sys.version.split()[0]}"
+    )
+
+
+if __name__ == "__main__":
+    main()
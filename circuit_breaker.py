@@ -0,0 +1,74 @@
+import threading
+import time
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of making an API call while the circuit is open
+    """
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self, failure_threshold=3, latency_threshold=5.0, reset_timeout=30.0
+    ):
+        """
+        Creates a circuit breaker that opens after failure_threshold
+        consecutive failures, counting calls slower than
+        latency_threshold seconds as failures. While open, calls are
+        refused so they fail fast. After reset_timeout seconds a single
+        probe call is let through, and the circuit closes if it succeeds.
+        """
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        Returns True if a call may be made now. When the circuit has
+        been open for long enough, the caller is allowed through as the
+        half-open probe.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            # A probe that never reported back is replaced by a new one.
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return True
+            return False
+
+    def record_success(self, latency):
+        """
+        Records a call that succeeded after the given number of seconds
+        """
+        if latency > self.latency_threshold:
+            self.record_failure()
+            return
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """
+        Records a failed or too slow call, opening the circuit if there
+        have been too many in a row or the half-open probe failed
+        """
+        with self.lock:
+            self.failures += 1
+            if (
+                self.state == self.HALF_OPEN
+                or self.failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
@@ -1,5 +1,34 @@
-const Pty = require('node-pty');
+const net = require('net');
+const { spawn } = require('child_process');
 const fs = require('fs');
+const path = require('path');
+
+const SESSION_HOST = '127.0.0.1';
+const SESSION_PORT = parseInt(process.env.TRAVEL_BUDGET_SESSION_PORT || '8700');
+
+// session_server.py hosts every session in one process, while
+// session_zygote.py forks a warmed-up process per session. Either way
+// each websocket is proxied to its own connection to it.
+const SESSION_SERVER = process.env.TRAVEL_BUDGET_SESSION_SERVER || 'session_server.py';
+
+// When set, the session server is started from the zipapp bundle built
+// by build_bundle.py rather than from the source files.
+const BUNDLE = process.env.TRAVEL_BUDGET_BUNDLE;
+
+const sessionArgs = BUNDLE
+    ? ['-S', BUNDLE, path.basename(SESSION_SERVER, '.py')]
+    : [SESSION_SERVER];
+
+const sessions = spawn('python3', sessionArgs.concat(['--port', SESSION_PORT]), {
+    cwd: process.env.PWD,
+    env: process.env,
+    stdio: 'inherit'
+});
+
+sessions.on('exit', function (code, signal) {
+    console.log("Session server exited", code, signal);
+    process.exit(1);
+});
 
 exports.install = function () {
 
@@ -15,19 +44,18 @@ function socket() {
 
     this.on('open', function (client) {
 
-        // Spawn terminal
-        client.tty = Pty.spawn('python3', ['run.py'], {
-            name: 'xterm-color',
-            cols: 80,
-            rows: 24,
-            cwd: process.env.PWD,
-            env: process.env
-        });
+        // Connect terminal
+        client.tty = net.connect(SESSION_PORT, SESSION_HOST);
+        client.tty.setEncoding('utf8');
 
-        client.tty.on('exit', function (code, signal) {
+        client.tty.on('close', function () {
             client.tty = null;
             client.close();
-            console.log("Process killed");
+            console.log("Session ended");
+        });
+
+        client.tty.on('error', function (err) {
+            console.log("Session connection error: ", err);
         });
 
         client.tty.on('data', function (data) {
@@ -38,9 +66,9 @@ function socket() {
 
     this.on('close', function (client) {
         if (client.tty) {
-            client.tty.kill(9);
+            client.tty.destroy();
             client.tty = null;
-            console.log("Process killed and terminal unloaded");
+            console.log("Session closed and terminal unloaded");
         }
     });
 
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+import uuid
+from file_lock import file_lock
+
+
+DEAD_LETTER_FILE = "dead_letters.jsonl"
+
+REJECTED_SUFFIX = ".rejected"
+"""
+Added to the queue's path for the file that entries the API rejects
+for good are moved to
+"""
+
+
+class DeadLetterQueue:
+    def __init__(self, path=DEAD_LETTER_FILE):
+        """
+        Creates a durable, append-only queue of document writes that
+        failed, stored as JSON lines in a local file shared by every
+        session process, so they can be replayed later in order
+        """
+        self.path = path
+
+    def add(self, document_id, user_uuid, parts):
+        """
+        Records a failed write of (kind, content) parts to a document
+        """
+        entry = {
+            "id": uuid.uuid4().hex,
+            "document_id": document_id,
+            "user_uuid": user_uuid,
+            "parts": parts,
+            "time": time.time(),
+        }
+        with file_lock(self.path + ".lock"):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self):
+        """
+        Returns every queued entry in the order it was added
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a crash mid-write is skipped.
+                continue
+        return entries
+
+    def remove(self, entry_ids):
+        """
+        Removes the entries with the given IDs from the queue
+        """
+        with file_lock(self.path + ".lock"):
+            remaining = [
+                entry for entry in self.load()
+                if entry["id"] not in entry_ids
+            ]
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for entry in remaining:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(temp_path, self.path)
+
+    def reject(self, entries, error):
+        """
+        Moves entries that can never be written, such as to a deleted
+        document, out of the queue into the rejected file along with
+        the error, so they are kept but never sent again
+        """
+        with file_lock(self.path + ".lock"):
+            with open(
+                self.path + REJECTED_SUFFIX, "a", encoding="utf-8"
+            ) as f:
+                for entry in entries:
+                    f.write(json.dumps({**entry, "error": str(error)}) + "\n")
+        self.remove({entry["id"] for entry in entries})
+
+    def replay_document(self, service, document_id, entries):
+        """
+        Writes a document's entries in a single batchUpdate and removes
+        them from the queue. If the API rejects the write with an error
+        that retrying will not fix, such as a 404 or 403, each entry is
+        tried on its own and those rejected again are set aside, so a
+        bad entry does not hold up the rest or get resent forever.
+        Raises the error of a write that may succeed later.
+        """
+        from googleapiclient.errors import HttpError
+        from google_api import is_retryable
+        from doc_writer import append_parts
+        batches = [entries]
+        while batches:
+            batch = batches.pop(0)
+            parts = [part for entry in batch for part in entry["parts"]]
+            try:
+                append_parts(service, document_id, parts)
+            except HttpError as error:
+                if is_retryable(error):
+                    raise
+                if len(batch) > 1:
+                    batches = [[entry] for entry in batch] + batches
+                else:
+                    self.reject(batch, error)
+                continue
+            self.remove({entry["id"] for entry in batch})
+
+    def replay(self, service, document_id=None):
+        """
+        Sends every queued write, or only those for one document, to its
+        document, coalescing all the entries for a document into a
+        single batchUpdate. Entries that fail in a way that may succeed
+        later stay queued, and those rejected for good are set aside.
+        Only one process replays at a time. Returns True if every entry it
+        looked at was written or set aside.
+        """
+        # The Google client stack is only loaded once there is
+        # something to replay, keeping it off the startup path.
+        from google_api import TRANSPORT_ERRORS
+        with file_lock(self.path + ".replay.lock", blocking=False) as got:
+            if not got:
+                return False
+            with file_lock(self.path + ".lock"):
+                entries = self.load()
+            if document_id is not None:
+                entries = [
+                    entry for entry in entries
+                    if entry["document_id"] == document_id
+                ]
+            replayed = True
+            by_document = {}
+            for entry in entries:
+                by_document.setdefault(entry["document_id"], []).append(entry)
+            for entry_document_id, document_entries in by_document.items():
+                try:
+                    self.replay_document(
+                        service, entry_document_id, document_entries
+                    )
+                except TRANSPORT_ERRORS:
+                    replayed = False
+            return replayed
+
+    def replay_in_background(self, get_service):
+        """
+        Replays the queue from a background thread, which gets its
+        client from get_service so building it does not delay the
+        caller. Failures leave the queue for a later replay rather than
+        being printed over the session.
+        """
+        def replay():
+            from google_api import TRANSPORT_ERRORS
+            try:
+                self.replay(get_service())
+            except (*TRANSPORT_ERRORS, ValueError):
+                # The client could not be built, such as without
+                # credentials.
+                pass
+
+        thread = threading.Thread(
+            target=replay,
+            name="dead-letter-replay",
+            daemon=True,
+        )
+        thread.start()
+        return thread
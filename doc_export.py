@@ -0,0 +1,128 @@
+import html
+import io
+import uuid
+from googleapiclient.http import MediaIoBaseUpload
+from google_api import execute, DRIVE_LIMIT, TRANSPORT_ERRORS
+from sinks import Sink, PendingUploadSink
+
+
+GOOGLE_DOC_MIME_TYPE = "application/vnd.google-apps.document"
+
+
+def render_html(parts):
+    """
+    Returns the HTML document for a list of ("text", text) and
+    ("table", rows) parts
+    """
+    body = []
+    for kind, content in parts:
+        if kind == "table":
+            table = "".join(
+                "<tr>"
+                + "".join(f"<td>{html.escape(cell)}</td>" for cell in row)
+                + "</tr>"
+                for row in content
+            )
+            body.append(f"<table>{table}</table>")
+        else:
+            body.extend(
+                f"<p>{html.escape(line)}</p>" for line in content.split("\n")
+            )
+    return (
+        '<html><head><meta charset="utf-8"></head><body>'
+        + "".join(body)
+        + "</body></html>"
+    )
+
+
+class DocumentExport(Sink):
+    def __init__(
+        self, drive_service, share_document, user_uuid=None, fallback=True
+    ):
+        """
+        Keeps the whole session's summary locally and uploads it as a
+        single converted Google Doc when the session ends, so a session
+        costs one Drive upload and one permission call however many
+        expenses it records. If the upload fails, the summary is kept
+        to be uploaded later, or the error is raised if fallback is off.
+        """
+        super().__init__()
+        self.drive_service = drive_service
+        self.share_document = share_document
+        self.user_uuid = user_uuid or str(uuid.uuid4())
+        self.use_fallback = fallback
+        self.document_id = None
+        self.fallback = None
+        self.parts = []
+
+    def append(self, text, section=None):
+        """ Adds a line of text to the locally kept document. """
+        self.parts.append(("text", text))
+
+    def append_table(self, rows, section=None):
+        """ Adds a table to the locally kept document. """
+        self.parts.append(("table", rows))
+
+    def flush(self):
+        """
+        Does nothing, as the document is only uploaded when it is closed
+        """
+
+    def drain(self):
+        """
+        Does nothing, as the document is only uploaded when it is closed
+        """
+
+    def close(self):
+        """
+        Uploads the document to Google Drive as HTML, converting it to
+        a Google Doc, and then makes it public
+        """
+        if self.document_id is not None or self.fallback is not None:
+            return
+        self.write_sections()
+        media = MediaIoBaseUpload(
+            io.BytesIO(render_html(self.parts).encode("utf-8")),
+            mimetype="text/html",
+        )
+        metadata = {
+            "name": f"Travel Budget Planner - {self.user_uuid}",
+            "mimeType": GOOGLE_DOC_MIME_TYPE,
+        }
+        try:
+            file = execute(
+                self.drive_service.files().create(
+                    body=metadata, media_body=media, fields="id"
+                ),
+                DRIVE_LIMIT,
+            )
+        except TRANSPORT_ERRORS as error:
+            if not self.use_fallback:
+                raise
+            print(f"An error occurred: {error}")
+            self.write_fallback()
+            return
+        self.document_id = file.get("id")
+        self.share_document(self.document_id)
+
+    def write_fallback(self):
+        """ Keeps the summary to be uploaded later. """
+        self.fallback = PendingUploadSink()
+        for kind, content in self.parts:
+            if kind == "table":
+                self.fallback.append_table(content)
+            else:
+                self.fallback.append(content)
+        self.fallback.close()
+
+    @property
+    def link(self):
+        """
+        Returns where the summary was saved, or None if it has not
+        been uploaded yet
+        """
+        if self.fallback is not None:
+            return self.fallback.link
+        if self.document_id is None:
+            return None
+        return f"https://docs.google.com/document/d/{self.document_id}"
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+from file_lock import file_lock
+
+
+POOL_FILE = "doc_pool.json"
+POOL_SIZE = 3
+
+
+class DocumentPool:
+    def __init__(self, create_document, path=POOL_FILE, size=POOL_SIZE):
+        """
+        Creates a pool of Google Docs that have already been created and
+        made public, so a session can be handed one without waiting.
+        The pool is stored in a local JSON file shared by every session
+        process so documents survive restarts.
+        """
+        self.create_document = create_document
+        self.path = path
+        self.size = size
+        self.stopping = threading.Event()
+        self.refill_thread = None
+
+    def locked(self, suffix=".lock", blocking=True):
+        """
+        Locks the pool file, or with another suffix one of its
+        companion locks, for the duration of a with block
+        """
+        return file_lock(self.path + suffix, blocking)
+
+    def load(self):
+        """
+        Returns the list of pooled documents, or an empty list if the
+        pool file is missing or unreadable
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def save(self, documents):
+        """
+        Atomically replaces the pool file with the given documents
+        """
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(documents, f)
+        os.replace(temp_path, self.path)
+
+    def take(self):
+        """
+        Removes a document from the pool and returns its user UUID and
+        document ID, or None if the pool is empty
+        """
+        with self.locked():
+            documents = self.load()
+            if not documents:
+                return None
+            document = documents.pop(0)
+            self.save(documents)
+        return document["user_uuid"], document["document_id"]
+
+    def acquire(self):
+        """
+        Returns a user UUID and document ID from the pool, creating a
+        document straight away if the pool is empty, and starts topping
+        the pool back up in the background
+        """
+        document = self.take()
+        if document is None:
+            document = self.create_document()
+        self.start_refill()
+        return document
+
+    def start_refill(self):
+        """
+        Starts a background thread that refills the pool
+        """
+        self.refill_thread = threading.Thread(
+            target=self.refill, name="doc-pool-refill", daemon=True
+        )
+        self.refill_thread.start()
+
+    def refill(self):
+        """
+        Creates documents until the pool is full. Only one process
+        refills the pool at a time so it is not overfilled.
+        """
+        # Imported here, in the background, to keep the Google client
+        # stack off the startup path.
+        from google_api import TRANSPORT_ERRORS
+        with self.locked(suffix=".refill.lock", blocking=False) as acquired:
+            if not acquired:
+                return
+            while not self.stopping.is_set():
+                with self.locked():
+                    if len(self.load()) >= self.size:
+                        return
+                try:
+                    user_uuid, document_id = self.create_document()
+                except TRANSPORT_ERRORS:
+                    return
+                with self.locked():
+                    documents = self.load()
+                    documents.append(
+                        {"user_uuid": user_uuid, "document_id": document_id}
+                    )
+                    self.save(documents)
+
+    def stop(self):
+        """
+        Stops refilling once the document being created, if any, has
+        been saved to the pool
+        """
+        self.stopping.set()
+        if self.refill_thread is not None:
+            self.refill_thread.join()
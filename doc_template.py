@@ -0,0 +1,219 @@
+import threading
+from google_api import execute, DOCS_WRITE_LIMIT, TRANSPORT_ERRORS
+from doc_writer import (
+    EMPTY_DOCUMENT_INDEX, text_requests, table_requests, parts_requests
+)
+from google_services import docs_service
+from sinks import Sink, PendingUploadSink
+
+
+TEXT_SECTIONS = ["initial_details", "expenses", "final_summary"]
+TABLE_SECTION = "expense_summary"
+TABLE_ROWS = 5
+TABLE_COLUMNS = 2
+
+
+def placeholder(name):
+    """ Returns the placeholder text for a name in the template. """
+    return f"{{{{{name}}}}}"
+
+
+def cell_placeholder(row, column):
+    """ Returns the placeholder for a cell of the summary table. """
+    return placeholder(f"{TABLE_SECTION}.{row}.{column}")
+
+
+def template_requests():
+    """
+    Returns the requests that lay out the template in an empty
+    document: styled headings, a placeholder for each section and a
+    table with a placeholder in each cell
+    """
+    layout = [
+        ("HEADING_1", "Travel Budget Planner\n"),
+        (None, f"{placeholder('user_uuid')}\n"),
+        ("HEADING_2", "Trip Details\n"),
+        (None, f"{placeholder('initial_details')}\n"),
+        ("HEADING_2", "Expenses\n"),
+        (None, f"{placeholder('expenses')}\n"),
+        ("HEADING_2", "Expense Summary\n"),
+        ("TABLE", None),
+        ("HEADING_2", "Final Summary\n"),
+        (None, f"{placeholder('final_summary')}\n"),
+    ]
+    requests = []
+    styles = []
+    index = EMPTY_DOCUMENT_INDEX
+    for style, text in layout:
+        if style == "TABLE":
+            rows = [
+                [
+                    cell_placeholder(row, column)
+                    for column in range(TABLE_COLUMNS)
+                ]
+                for row in range(TABLE_ROWS)
+            ]
+            part_requests, length = table_requests(rows, index)
+        else:
+            part_requests, length = text_requests(text, index)
+            if style is not None:
+                styles.append(
+                    {
+                        "updateParagraphStyle": {
+                            "range": {
+                                "startIndex": index,
+                                "endIndex": index + length,
+                            },
+                            "paragraphStyle": {"namedStyleType": style},
+                            "fields": "namedStyleType",
+                        }
+                    }
+                )
+        requests.extend(part_requests)
+        index += length
+    return requests + styles
+
+
+def create_template(service):
+    """
+    Creates the template document and returns its ID
+    """
+    document = execute(
+        service.documents().create(
+            body={"title": "Travel Budget Planner Template"}
+        ),
+        DOCS_WRITE_LIMIT,
+    )
+    document_id = document["documentId"]
+    execute(
+        service.documents().batchUpdate(
+            documentId=document_id,
+            body={"requests": template_requests()},
+        ),
+        DOCS_WRITE_LIMIT,
+    )
+    return document_id
+
+
+class TemplateDocument(Sink):
+    def __init__(self, service, document, dead_letters=None, dispatcher=None):
+        """
+        Fills in a copy of the template document. Output is collected
+        by section and written at the end of the session as a single
+        batchUpdate of replaceAllText requests, so a session makes the
+        same number of write requests however many expenses it records.
+        The document is a future resolving to the user UUID and ID of
+        the copy.
+        """
+        super().__init__()
+        self.service = service
+        self.document = document
+        self.dead_letters = dead_letters
+        self.dispatcher = dispatcher
+        self.sections = {name: [] for name in TEXT_SECTIONS}
+        self.table_rows = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.fallback = None
+
+    @property
+    def user_uuid(self):
+        """ Waits for the document and returns the session's UUID. """
+        if self.fallback is not None:
+            return self.fallback.user_uuid
+        return self.document.result()[0]
+
+    @property
+    def document_id(self):
+        """ Waits for the document and returns its ID. """
+        return self.document.result()[1]
+
+    @property
+    def link(self):
+        if self.fallback is not None:
+            return self.fallback.link
+        return f"https://docs.google.com/document/d/{self.document_id}"
+
+    def append(self, text, section=None):
+        if section in self.sections:
+            self.sections[section].append(text.strip("\n"))
+
+    def append_table(self, rows, section=None):
+        if section == TABLE_SECTION:
+            self.table_rows = rows
+
+    def replace_section(self, section, parts):
+        if section in self.sections:
+            self.sections[section] = [
+                content.strip("\n")
+                for kind, content in parts
+                if kind == "text"
+            ]
+        if section == TABLE_SECTION:
+            for kind, content in parts:
+                if kind == "table":
+                    self.table_rows = content
+
+    def replacements(self):
+        """
+        Returns the text for every placeholder in the template. Unused
+        placeholders are replaced with empty text.
+        """
+        replacements = {placeholder("user_uuid"): self.user_uuid}
+        for name, texts in self.sections.items():
+            replacements[placeholder(name)] = "\n\n".join(texts)
+        for row in range(TABLE_ROWS):
+            for column in range(TABLE_COLUMNS):
+                try:
+                    text = self.table_rows[row][column]
+                except IndexError:
+                    text = ""
+                replacements[cell_placeholder(row, column)] = text
+        return replacements
+
+    def close(self):
+        """
+        Fills in every placeholder of the document in one batchUpdate.
+        If the copy could not be made, the summary is kept to be
+        uploaded as a new document later instead.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.document.exception() is not None:
+            self.fallback = PendingUploadSink()
+            for texts in self.sections.values():
+                for text in texts:
+                    self.fallback.append(text)
+            if self.table_rows:
+                self.fallback.append_table(self.table_rows)
+            self.fallback.close()
+            return
+        parts = [("replace", self.replacements())]
+        requests, _ = parts_requests(parts, EMPTY_DOCUMENT_INDEX)
+        try:
+            execute(
+                self.service.documents().batchUpdate(
+                    documentId=self.document_id,
+                    body={"requests": requests},
+                ),
+                DOCS_WRITE_LIMIT,
+                dispatcher=self.dispatcher,
+            )
+        except TRANSPORT_ERRORS as error:
+            print(f"An error occurred: {error}")
+            if self.dead_letters is not None:
+                self.dead_letters.add(self.document_id, self.user_uuid, parts)
+
+
+def main():
+    """
+    Creates the template document and prints the ID to set as
+    TRAVEL_BUDGET_TEMPLATE_ID
+    """
+    print(create_template(docs_service()))
+
+
+if __name__ == "__main__":
+    main()
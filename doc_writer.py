@@ -0,0 +1,700 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from google_api import (
+    execute, DOCS_READ_LIMIT, DOCS_WRITE_LIMIT, TRANSPORT_ERRORS
+)
+from sinks import Sink, PendingUploadSink
+from metrics import for_this_session
+
+
+EMPTY_DOCUMENT_INDEX = 1
+"""
+Index at which text is inserted into a newly created, empty Google Doc
+"""
+
+
+def utf16_length(text):
+    """
+    Returns the length of the text in UTF-16 code units, which is how
+    the Google Docs API measures indexes
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def text_requests(text, index):
+    """
+    Returns the requests that insert text at the index and the number
+    of indexes the text takes up
+    """
+    request = {
+        "insertText": {
+            "location": {"index": index},
+            "text": text,
+        }
+    }
+    return [request], utf16_length(text)
+
+
+def table_requests(rows, index):
+    """
+    Returns the requests that insert a table holding the rows of cell
+    text at the index and the number of indexes the filled table takes
+    up. insertTable adds a newline before the table, then the table
+    takes one index for itself, one per row and two per empty cell.
+    Cells are filled from last to first so that each insert leaves the
+    indexes of the cells before it unchanged.
+    """
+    columns = len(rows[0])
+    row_size = 1 + 2 * columns
+    requests = [
+        {
+            "insertTable": {
+                "location": {"index": index},
+                "rows": len(rows),
+                "columns": columns,
+            }
+        }
+    ]
+    length = 2 + len(rows) * row_size
+    cells = []
+    for row_number, row in enumerate(rows):
+        for column_number, cell_text in enumerate(row):
+            cell_index = (
+                index + 4 + row_number * row_size + 2 * column_number
+            )
+            cells.append((cell_index, cell_text))
+    for cell_index, cell_text in reversed(cells):
+        if cell_text:
+            cell_request, cell_length = text_requests(cell_text, cell_index)
+            requests.extend(cell_request)
+            length += cell_length
+    return requests, length
+
+
+def replace_requests(replacements, index):
+    """
+    Returns replaceAllText requests that swap each placeholder in the
+    replacements dict for its text. These do not insert at the index,
+    so they take up no indexes of their own.
+    """
+    requests = [
+        {
+            "replaceAllText": {
+                "containsText": {"text": placeholder, "matchCase": True},
+                "replaceText": text,
+            }
+        }
+        for placeholder, text in replacements.items()
+    ]
+    return requests, 0
+
+
+def named_range_request(name, start, end):
+    """
+    Returns the request that marks the indexes from start to end with a
+    named range
+    """
+    return {
+        "createNamedRange": {
+            "name": name,
+            "range": {"startIndex": start, "endIndex": end},
+        }
+    }
+
+
+def section_requests(section, index):
+    """
+    Returns the requests that insert a section's parts at the index and
+    mark them with a named range called after the section, and the
+    number of indexes the parts take up
+    """
+    requests, end_index = parts_requests(section["parts"], index)
+    if end_index > index:
+        requests.append(named_range_request(section["name"], index, end_index))
+    return requests, end_index - index
+
+
+PART_REQUESTS = {
+    "text": text_requests,
+    "table": table_requests,
+    "replace": replace_requests,
+    "section": section_requests,
+}
+"""
+Functions that build the requests for each kind of queued document part
+"""
+
+
+def parts_requests(parts, index):
+    """
+    Returns the requests that insert a list of (kind, content) parts
+    one after another from the index, and the index after the last part
+    """
+    requests = []
+    for kind, content in parts:
+        part_requests, length = PART_REQUESTS[kind](content, index)
+        requests.extend(part_requests)
+        index += length
+    return requests, index
+
+
+def delete_request(start, end):
+    """ Returns the request that deletes the indexes from start to end. """
+    return {
+        "deleteContentRange": {
+            "range": {"startIndex": start, "endIndex": end},
+        }
+    }
+
+
+def parts_shape(parts):
+    """
+    Returns the kind of each part and the size of each table, which
+    must match for one set of parts to be edited into another
+    """
+    return [
+        (kind, (len(content), len(content[0])) if kind == "table" else None)
+        for kind, content in parts
+    ]
+
+
+def part_spans(parts):
+    """
+    Returns the offset from the first part and the text of every run of
+    text in a list of text and table parts, each table cell being one
+    run, and the number of indexes the parts take up
+    """
+    spans = []
+    offset = 0
+    for kind, content in parts:
+        if kind != "table":
+            spans.append((offset, content))
+            offset += utf16_length(content)
+            continue
+        row_size = 1 + 2 * len(content[0])
+        filled = 0
+        for row_number, row in enumerate(content):
+            for column_number, cell_text in enumerate(row):
+                cell_offset = (
+                    offset + 4 + row_number * row_size + 2 * column_number
+                )
+                spans.append((cell_offset + filled, cell_text))
+                filled += utf16_length(cell_text)
+        offset += 2 + len(content) * row_size + filled
+    return spans, offset
+
+
+def text_edit_requests(index, old, new):
+    """
+    Returns the requests that turn the text old at the index into new,
+    deleting and inserting only what lies between the text the two
+    share at either end
+    """
+    prefix = len(os.path.commonprefix([old, new]))
+    suffix = len(
+        os.path.commonprefix([old[prefix:][::-1], new[prefix:][::-1]])
+    )
+    start = index + utf16_length(old[:prefix])
+    requests = []
+    removed = old[prefix:len(old) - suffix]
+    if removed:
+        requests.append(delete_request(start, start + utf16_length(removed)))
+    added = new[prefix:len(new) - suffix]
+    if added:
+        requests.extend(text_requests(added, start)[0])
+    return requests
+
+
+def update_requests(start, old_parts, old_length, parts):
+    """
+    Returns the requests that replace a section's old parts at the start
+    index with new parts, and the number of indexes the new parts take
+    up. If the parts have the same shape as before only the changed
+    text of each run is deleted and inserted, so the request stays the
+    same size however long the section grows. Otherwise, or if the old
+    parts are not known, the whole section is deleted and inserted again.
+    """
+    spans, length = part_spans(parts)
+    requests = []
+    if old_parts is not None and parts_shape(old_parts) == parts_shape(parts):
+        old_spans, _ = part_spans(old_parts)
+        # Runs are edited from last to first so that each edit leaves
+        # the indexes of the runs before it unchanged.
+        for (offset, old), (_, new) in reversed(list(zip(old_spans, spans))):
+            requests.extend(text_edit_requests(start + offset, old, new))
+        return requests, length
+    if old_length:
+        requests.append(delete_request(start, start + old_length))
+    requests.extend(parts_requests(parts, start)[0])
+    return requests, length
+
+
+def fetch_document(service, document_id):
+    """ Reads the document. """
+    return execute(
+        service.documents().get(documentId=document_id),
+        DOCS_READ_LIMIT,
+    )
+
+
+def end_index_of(document):
+    """
+    Returns the index at which new text should be inserted into a
+    document read from the API
+    """
+    document_length = document.get(
+        "body", {}
+    ).get("content", [])[-1]["endIndex"]
+    return document_length - 1
+
+
+def named_ranges_of(document):
+    """
+    Returns the start and end index of each named range in a document
+    read from the API, taking the last if a name is used more than once
+    """
+    ranges = {}
+    for name, named_ranges in document.get("namedRanges", {}).items():
+        spans = [
+            (text_range["startIndex"], text_range["endIndex"])
+            for named_range in named_ranges.get("namedRanges", [])
+            for text_range in named_range.get("ranges", [])
+        ]
+        if spans:
+            ranges[name] = max(spans)
+    return ranges
+
+
+def sections_of(document):
+    """
+    Returns the start and length of each section in a document read
+    from the API. Their parts are not known, so each is rewritten in
+    full the first time it is replaced.
+    """
+    return {
+        name: {"start": start, "length": end - start, "parts": None}
+        for name, (start, end) in named_ranges_of(document).items()
+    }
+
+
+def section_update(sections, section):
+    """
+    Returns the requests that update a section already in the document
+    in place and recreate its named range, and how many indexes the
+    document grew by. Updates the sections model to match.
+    """
+    layout = sections[section["name"]]
+    start = layout["start"]
+    requests, length = update_requests(
+        start, layout["parts"], layout["length"], section["parts"]
+    )
+    requests.append({"deleteNamedRange": {"name": section["name"]}})
+    if length:
+        requests.append(
+            named_range_request(section["name"], start, start + length)
+        )
+    growth = length - layout["length"]
+    for other in sections.values():
+        if other["start"] > start:
+            other["start"] += growth
+    layout.update(length=length, parts=section["parts"])
+    return requests, growth
+
+
+def write_requests(parts, index, sections):
+    """
+    Returns the requests that write a list of parts at the index, the
+    end of the document, and the index after them. Sections already in
+    the sections model are updated where they are rather than added
+    again, and the model is updated to match.
+    """
+    requests = []
+    for kind, content in parts:
+        if kind == "section" and content["name"] in sections:
+            part_requests, growth = section_update(sections, content)
+            index += growth
+        else:
+            part_requests, length = PART_REQUESTS[kind](content, index)
+            if kind == "section":
+                sections[content["name"]] = {
+                    "start": index,
+                    "length": length,
+                    "parts": content["parts"],
+                }
+            index += length
+        requests.extend(part_requests)
+    return requests, index
+
+
+def fetch_end_index(service, document_id):
+    """
+    Reads the document and returns the index at which new text
+    should be inserted
+    """
+    return end_index_of(fetch_document(service, document_id))
+
+
+def batch_update_body(requests, revision_id=None):
+    """
+    Returns the body of a batchUpdate. If the revision ID is known the
+    update is only applied to that revision of the document, and fails
+    with a 400 error if anyone has changed the document since.
+    """
+    body = {"requests": requests}
+    if revision_id is not None:
+        body["writeControl"] = {"requiredRevisionId": revision_id}
+    return body
+
+
+def revision_after(response):
+    """
+    Returns the revision ID of a document after a successful batchUpdate
+    """
+    return response.get("writeControl", {}).get("requiredRevisionId")
+
+
+def append_parts(service, document_id, parts):
+    """
+    Reads the document and inserts the parts at its end, as long as
+    nobody else changed the document in between. If they did, the
+    document is read again and the insert tried once more. Sections
+    already in the document are replaced where they are.
+    """
+    for attempt in range(2):
+        document = fetch_document(service, document_id)
+        requests, _ = write_requests(
+            parts, end_index_of(document), sections_of(document)
+        )
+        try:
+            return execute(
+                service.documents().batchUpdate(
+                    documentId=document_id,
+                    body=batch_update_body(
+                        requests, document.get("revisionId")
+                    ),
+                ),
+                DOCS_WRITE_LIMIT,
+            )
+        except HttpError as error:
+            if error.resp.status != 400 or attempt:
+                raise
+
+
+class DocumentWriter(Sink):
+    def __init__(
+        self,
+        service,
+        document,
+        flush_threshold=5000,
+        end_index=EMPTY_DOCUMENT_INDEX,
+        dead_letters=None,
+        dispatcher=None,
+        executor=None,
+    ):
+        """
+        Creates a write-behind buffer for a Google Doc. Text appended
+        during the session is queued locally and sent to the document
+        in a single batchUpdate when flushed.
+        The document is a future resolving to the user UUID and document
+        ID, so the session can start before the document exists; only
+        the background writes and anything asking for the document ID
+        wait for it.
+        The writer keeps its own cursor at the end of the document so it
+        does not need to fetch the document before every write. Pass
+        end_index=None for a document whose contents are unknown.
+        Each write requires the revision the writer last saw, so a write
+        to a document changed by anyone else fails rather than landing
+        at the wrong index, and the writer only reads the document again
+        then.
+        Writes are made in the background on the executor, so flushing
+        never blocks the prompts. Writers can share an executor, as one
+        writer's batches are written one at a time, in order, and only
+        once its document exists. Without one, the writer has a thread
+        of its own.
+        Writes that fail are recorded in the dead letter queue, if given,
+        and so is every later write to the document until the queue has
+        been replayed into it, so the document's text stays in order.
+        If a BatchDispatcher is given, writes are batched with those of
+        other sessions.
+        Replaced sections are kept in named ranges, and the writer keeps
+        the start, length and parts of each so it can edit them in place.
+        """
+        super().__init__()
+        self.service = service
+        self.document = document
+        self.flush_threshold = flush_threshold
+        self.end_index = end_index
+        self.revision_id = None
+        self.sections = {}
+        self.dead_letters = dead_letters
+        self.dispatcher = dispatcher
+        self.failed = False
+        self.fallback = None
+        self.pending = []
+        self.pending_size = 0
+        self.writes = queue.Queue()
+        self.writing = False
+        self.lock = threading.Lock()
+        self.owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="doc-writer"
+            )
+        self.executor = executor
+        self.write_queued = for_this_session(self.write_queued)
+        self.document.add_done_callback(lambda _: self.schedule())
+
+    @property
+    def user_uuid(self):
+        """ Waits for the document and returns the session's UUID. """
+        if self.fallback is not None:
+            return self.fallback.user_uuid
+        return self.document.result()[0]
+
+    @property
+    def document_id(self):
+        """ Waits for the document and returns its ID. """
+        return self.document.result()[1]
+
+    @property
+    def link(self):
+        if self.fallback is not None:
+            return self.fallback.link
+        return f"https://docs.google.com/document/d/{self.document_id}"
+
+    def append(self, text, section=None):
+        """
+        Queues a line of text to be added to the end of the document.
+        The queue is flushed once it grows past the size threshold.
+        """
+        line = f"{text}\n"
+        size = len(line)
+        if self.pending and self.pending[-1][0] == "text":
+            # Consecutive lines are sent as a single insertText.
+            line = self.pending.pop()[1] + line
+        self.queue_part("text", line, size)
+
+    def append_table(self, rows, section=None):
+        """
+        Queues a table, given as a list of rows of cell text, to be
+        added to the end of the document
+        """
+        size = sum(len(cell_text) for row in rows for cell_text in row)
+        self.queue_part("table", rows, size)
+
+    def replace_section(self, section, parts):
+        """
+        Queues the parts to replace the section. The first time, they
+        are added at the end of the document in a named range; after
+        that the range is edited in place. If the section is still
+        queued, its queued parts are replaced instead.
+        """
+        content = {"name": section, "parts": parts}
+        for position, (kind, queued) in enumerate(self.pending):
+            if kind == "section" and queued["name"] == section:
+                self.pending[position] = ("section", content)
+                return
+        size = sum(
+            utf16_length(text) for _, text in part_spans(parts)[0]
+        )
+        self.queue_part("section", content, size)
+
+    def queue_part(self, kind, content, size):
+        """
+        Queues a part of the document. Its requests are only built when
+        it is written, once its index is known.
+        """
+        self.pending.append((kind, content))
+        self.pending_size += size
+        if self.pending_size >= self.flush_threshold:
+            self.flush()
+
+    def flush(self):
+        """
+        Hands all queued parts to be sent to the document in the
+        background in one batchUpdate. Does not wait for the write.
+        """
+        if not self.pending:
+            return
+        parts = self.pending
+        self.pending = []
+        self.pending_size = 0
+        self.writes.put(parts)
+        self.schedule()
+
+    def drain(self):
+        """
+        Flushes queued text and waits until everything handed to the
+        background so far has been written
+        """
+        self.flush()
+        self.writes.join()
+
+    def schedule(self):
+        """
+        Starts writing the flushed batches on the executor, unless they
+        are already being written or the document is not ready yet
+        """
+        with self.lock:
+            if self.writing or self.writes.empty():
+                return
+            if not self.document.done():
+                # The document's done callback schedules them.
+                return
+            self.writing = True
+        self.executor.submit(self.write_queued)
+
+    def write_queued(self):
+        """
+        Writes batches to the document in the order they were flushed
+        until none are left. A batch that fails in a way write does not
+        handle is kept rather than stopping, which would leave drain and
+        close waiting forever.
+        """
+        while True:
+            with self.lock:
+                if self.writes.empty():
+                    self.writing = False
+                    return
+            parts = self.writes.get()
+            try:
+                self.write(parts)
+            except Exception as error:
+                self.salvage(parts, error)
+            finally:
+                self.writes.task_done()
+
+    def salvage(self, parts, error):
+        """
+        Keeps parts that failed to be written for an unexpected reason.
+        They are spooled to the dead letter queue like any failed write,
+        or are kept to be uploaded later if there is no queue.
+        """
+        try:
+            if self.dead_letters is not None and self.fallback is None:
+                self.failed = True
+                self.dead_letters.add(self.document_id, self.user_uuid, parts)
+                return
+            if self.fallback is None:
+                self.fallback = PendingUploadSink()
+            self.write_fallback(parts)
+        except Exception as salvage_error:
+            print(f"An error occurred: {error}, then {salvage_error}")
+
+    def write_fallback(self, parts):
+        """ Writes parts to the fallback kept to be uploaded later. """
+        for kind, content in parts:
+            if kind == "table":
+                self.fallback.append_table(content)
+            elif kind == "section":
+                self.fallback.replace_section(
+                    content["name"], content["parts"]
+                )
+            else:
+                self.fallback.append(content.removesuffix("\n"))
+
+    def write(self, parts):
+        """
+        Inserts a batch of parts at the end of the document, resyncing
+        the cursor once if the document has changed underneath it,
+        which the API reports as a 400 error.
+        If the document could not be created the parts are kept to be
+        uploaded as a new document later instead. While earlier writes
+        are still spooled in the dead letter queue, the spool is
+        replayed into the document first, and the parts are spooled
+        too if that fails.
+        """
+        if self.fallback is None and self.document.exception() is not None:
+            self.fallback = PendingUploadSink()
+        if self.fallback is not None:
+            self.write_fallback(parts)
+            return
+        if self.failed and not self.reconcile():
+            self.dead_letters.add(self.document_id, self.user_uuid, parts)
+            return
+        try:
+            if self.end_index is None:
+                self.resync()
+            try:
+                self.insert_parts(parts)
+            except HttpError as error:
+                if error.resp.status != 400:
+                    raise
+                # The document has moved on from the revision the cursor
+                # was based on, so resync from it and try once more.
+                self.resync()
+                self.insert_parts(parts)
+        except TRANSPORT_ERRORS as error:
+            if self.dead_letters is None:
+                print(f"An error occurred: {error}")
+                return
+            self.failed = True
+            self.dead_letters.add(self.document_id, self.user_uuid, parts)
+
+    def reconcile(self):
+        """
+        Replays this document's spooled writes from the dead letter
+        queue. Returns True once the spool is empty, after which the
+        cursor is resynced from the document. Fails fast without a
+        request while the Google circuit breaker is open.
+        """
+        if not self.dead_letters.replay(self.service, self.document_id):
+            return False
+        self.failed = False
+        self.end_index = None
+        return True
+
+    def resync(self):
+        """
+        Reads the cursor and the position of each section from the
+        document. As the text of the sections may have changed, each is
+        rewritten in full the next time it is replaced.
+        """
+        document = fetch_document(self.service, self.document_id)
+        self.end_index = end_index_of(document)
+        self.revision_id = document.get("revisionId")
+        self.sections = sections_of(document)
+
+    def insert_parts(self, parts):
+        """
+        Inserts the parts at the cursor and advances the cursor past
+        them. Sections already in the document are updated where they
+        are. The model of the sections is only changed once the write
+        has succeeded.
+        """
+        sections = {
+            name: dict(layout) for name, layout in self.sections.items()
+        }
+        requests, index = write_requests(parts, self.end_index, sections)
+        response = execute(
+            self.service.documents().batchUpdate(
+                documentId=self.document_id,
+                body=batch_update_body(requests, self.revision_id),
+            ),
+            DOCS_WRITE_LIMIT,
+            dispatcher=self.dispatcher,
+        )
+        self.end_index = index
+        self.revision_id = revision_after(response)
+        self.sections = sections
+
+    def close(self):
+        """
+        Writes any remaining text at the end of the session, and stops
+        the writer's own thread if it has one. Writes still spooled
+        after a last replay stay in the dead letter queue for a later
+        one.
+        """
+        self.drain()
+        if self.owns_executor:
+            self.executor.shutdown()
+        if self.failed:
+            try:
+                self.reconcile()
+            except Exception as error:
+                print(f"An error occurred: {error}")
+        if self.fallback is not None:
+            self.fallback.close()
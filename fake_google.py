@@ -0,0 +1,522 @@
+"""
+A local stand-in for the parts of the Google Docs v1 and Drive v3 APIs
+used by the Travel Budget Planner, including their HTTP batch endpoints,
+for offline testing and benchmarking.
+
+Start it with e.g.
+    python3 fake_google.py --port 8765 --latency 0.05 --error-rate 0.01
+and point the app at it with
+    GOOGLE_API_ENDPOINT=http://127.0.0.1:8765 python3 run.py
+"""
+import argparse
+import email
+import html
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from array import array
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from google_api import TokenBucket
+
+
+STRUCTURE = "\ue000"
+"""
+Placeholder for an index taken up by table structure rather than text
+"""
+
+BATCH_PATHS = {"/batch", "/batch/drive/v3"}
+"""
+Batch endpoints of the Docs and Drive APIs
+"""
+
+
+def to_units(text):
+    """
+    Returns the text as a string with one character per UTF-16 code
+    unit, so string positions match Google Docs indexes
+    """
+    return "".join(chr(unit) for unit in array("H", text.encode("utf-16-le")))
+
+
+def from_units(units):
+    """ Converts a string of UTF-16 code units back to normal text. """
+    return units.encode("utf-16-le", "surrogatepass").decode("utf-16-le")
+
+
+class ApiError(Exception):
+    def __init__(self, code, status, message):
+        """
+        An error returned to the client in Google's JSON error format
+        """
+        super().__init__(message)
+        self.code = code
+        self.status = status
+        self.message = message
+
+
+class FakeDocument:
+    def __init__(self, title, text=""):
+        """
+        Holds a document as a single run of UTF-16 code units. The body
+        always ends with a newline, as a real Google Doc does.
+        """
+        self.document_id = uuid.uuid4().hex
+        self.title = title
+        self.units = to_units(text) + "\n"
+        self.named_ranges = {}
+        self.revision = 1
+
+    @property
+    def revision_id(self):
+        """ Returns the document's revision in the Docs API format. """
+        return f"rev-{self.revision}"
+
+    def to_json(self):
+        """ Returns the document as the Docs API get method would. """
+        text = from_units(self.units.replace(STRUCTURE, ""))
+        named_ranges = {}
+        for range_id, (name, start, end) in self.named_ranges.items():
+            named_ranges.setdefault(
+                name, {"name": name, "namedRanges": []}
+            )["namedRanges"].append(
+                {
+                    "namedRangeId": range_id,
+                    "name": name,
+                    "ranges": [{"startIndex": start, "endIndex": end}],
+                }
+            )
+        return {
+            "documentId": self.document_id,
+            "title": self.title,
+            "revisionId": self.revision_id,
+            "body": {
+                "content": [
+                    {"endIndex": 1, "sectionBreak": {}},
+                    {
+                        "startIndex": 1,
+                        "endIndex": 1 + len(self.units),
+                        "paragraph": {
+                            "elements": [{"textRun": {"content": text}}]
+                        },
+                    },
+                ]
+            },
+            "namedRanges": named_ranges,
+        }
+
+    def check_range(self, text_range):
+        """
+        Raises a 400 error unless the range lies within the body and
+        leaves the final newline alone
+        """
+        start, end = text_range["startIndex"], text_range["endIndex"]
+        if not 1 <= start < end <= len(self.units):
+            raise ApiError(
+                400, "INVALID_ARGUMENT", f"Invalid range {start}-{end}."
+            )
+        return start, end
+
+    def check_index(self, index):
+        """
+        Raises a 400 error unless text can be inserted at the index
+        """
+        position = index - 1
+        if (
+            position < 0
+            or position >= len(self.units)
+            or self.units[position] == STRUCTURE
+        ):
+            raise ApiError(
+                400,
+                "INVALID_ARGUMENT",
+                f"Index {index} must be inside an existing paragraph.",
+            )
+
+    def insert(self, index, units):
+        """ Inserts UTF-16 code units before the index. """
+        self.check_index(index)
+        position = index - 1
+        self.units = self.units[:position] + units + self.units[position:]
+        for range_id, (name, start, end) in self.named_ranges.items():
+            self.named_ranges[range_id] = (
+                name,
+                start + len(units) if start >= index else start,
+                end + len(units) if end > index else end,
+            )
+
+    def delete(self, start, end):
+        """
+        Deletes the indexes from start to end, dropping named ranges
+        left empty
+        """
+        if any(unit == STRUCTURE for unit in self.units[start - 1:end - 1]):
+            # Tables may only be deleted whole, with the newline before.
+            opened = self.units[start - 1:end].count("\n" + STRUCTURE * 2)
+            if opened == 0 or self.units[end - 1] == STRUCTURE:
+                raise ApiError(
+                    400,
+                    "INVALID_ARGUMENT",
+                    "Tables can only be deleted in full.",
+                )
+        self.units = self.units[:start - 1] + self.units[end - 1:]
+
+        def shift(index):
+            return index - max(0, min(index, end) - start)
+
+        for range_id, (name, range_start, range_end) in list(
+            self.named_ranges.items()
+        ):
+            range_start, range_end = shift(range_start), shift(range_end)
+            if range_start < range_end:
+                self.named_ranges[range_id] = (name, range_start, range_end)
+            else:
+                del self.named_ranges[range_id]
+
+    def apply(self, request):
+        """ Applies a single batchUpdate request to the document. """
+        if "insertText" in request:
+            insert_text = request["insertText"]
+            self.insert(
+                insert_text["location"]["index"],
+                to_units(insert_text["text"]),
+            )
+        elif "insertTable" in request:
+            insert_table = request["insertTable"]
+            row = STRUCTURE + (STRUCTURE + "\n") * insert_table["columns"]
+            self.insert(
+                insert_table["location"]["index"],
+                "\n" + STRUCTURE + row * insert_table["rows"],
+            )
+        elif "replaceAllText" in request:
+            replace = request["replaceAllText"]
+            search = to_units(replace["containsText"]["text"])
+            if not search:
+                raise ApiError(
+                    400, "INVALID_ARGUMENT", "Search text must not be empty."
+                )
+            count = self.units.count(search)
+            self.units = self.units.replace(
+                search, to_units(replace["replaceText"])
+            )
+            return {"replaceAllText": {"occurrencesChanged": count}}
+        elif "deleteContentRange" in request:
+            self.delete(
+                *self.check_range(request["deleteContentRange"]["range"])
+            )
+        elif "createNamedRange" in request:
+            create = request["createNamedRange"]
+            start, end = self.check_range(create["range"])
+            range_id = f"kix.{uuid.uuid4().hex[:12]}"
+            self.named_ranges[range_id] = (create["name"], start, end)
+            return {"createNamedRange": {"namedRangeId": range_id}}
+        elif "deleteNamedRange" in request:
+            name = request["deleteNamedRange"]["name"]
+            self.named_ranges = {
+                range_id: named_range
+                for range_id, named_range in self.named_ranges.items()
+                if named_range[0] != name
+            }
+        elif "updateParagraphStyle" in request:
+            text_range = request["updateParagraphStyle"]["range"]
+            if not (
+                1 <= text_range["startIndex"] < text_range["endIndex"]
+                <= len(self.units) + 1
+            ):
+                raise ApiError(
+                    400, "INVALID_ARGUMENT", "Invalid paragraph style range."
+                )
+        else:
+            raise ApiError(
+                400,
+                "INVALID_ARGUMENT",
+                f"Unsupported request: {', '.join(request)}",
+            )
+        return {}
+
+    def batch_update(self, body):
+        """
+        Applies all requests in a batchUpdate, or none of them if any
+        request is invalid
+        """
+        required = body.get("writeControl", {}).get("requiredRevisionId")
+        if required is not None and required != self.revision_id:
+            raise ApiError(
+                400,
+                "FAILED_PRECONDITION",
+                f"Revision {required} is not the latest revision of the "
+                "document.",
+            )
+        units, named_ranges = self.units, dict(self.named_ranges)
+        try:
+            replies = [self.apply(request) for request in body["requests"]]
+        except ApiError:
+            self.units, self.named_ranges = units, named_ranges
+            raise
+        self.revision += 1
+        return {
+            "documentId": self.document_id,
+            "replies": replies,
+            "writeControl": {"requiredRevisionId": self.revision_id},
+        }
+
+
+class FakeGoogle:
+    def __init__(self, latency=0.0, error_rate=0.0, quota_per_minute=None):
+        """
+        Holds the state of the fake APIs and the faults to inject
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota = None
+        if quota_per_minute:
+            self.quota = TokenBucket(
+                rate=quota_per_minute / 60, capacity=quota_per_minute
+            )
+        self.documents = {}
+        self.permissions = {}
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """ Sleeps for around the configured latency. """
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+    def check_errors(self):
+        """ Raises the configured quota and server errors. """
+        if self.quota is not None and not self.quota.acquire(timeout=0):
+            raise ApiError(
+                429, "RESOURCE_EXHAUSTED", "Quota exceeded for quota metric."
+            )
+        if random.random() < self.error_rate:
+            raise ApiError(503, "UNAVAILABLE", "The service is unavailable.")
+
+    def get_document(self, document_id):
+        """ Returns the document or raises a 404 error. """
+        document = self.documents.get(document_id)
+        if document is None:
+            raise ApiError(
+                404, "NOT_FOUND", f"Requested entity {document_id} not found."
+            )
+        return document
+
+    def create_document(self, title, text=""):
+        """ Creates and stores a new document. """
+        document = FakeDocument(title, text)
+        self.documents[document.document_id] = document
+        return document
+
+    def handle(self, method, path, content_type, body):
+        """
+        Handles a single API request with the configured faults
+        """
+        self.delay()
+        self.check_errors()
+        return self.route(method, path, content_type, body)
+
+    def handle_batch(self, content_type, body):
+        """
+        Handles a multipart/mixed batch of API requests, applying the
+        configured latency once and the configured errors to each
+        request. Returns the content type and body of the multipart
+        response.
+        """
+        self.delay()
+        message = email.message_from_bytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload(decode=True).replace(b"\r\n", b"\n")
+            head, _, request_body = request.partition(b"\n\n")
+            request_line, *header_lines = head.decode().split("\n")
+            method, path, _ = request_line.split(" ", 2)
+            headers = dict(
+                line.split(": ", 1) for line in header_lines if line
+            )
+            try:
+                self.check_errors()
+                status, response = 200, self.route(
+                    method,
+                    urlparse(path).path,
+                    headers.get("Content-Type", ""),
+                    request_body,
+                )
+            except ApiError as error:
+                status, response = error.code, error_json(error)
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(response)}\r\n"
+            )
+        payload = "".join(parts) + f"--{boundary}--\r\n"
+        return (
+            f"multipart/mixed; boundary={boundary}",
+            payload.encode("utf-8"),
+        )
+
+    def route(self, method, path, content_type, body):
+        """
+        Routes a request to the matching fake API method and returns
+        the JSON response
+        """
+        with self.lock:
+            if method == "POST" and path == "/v1/documents":
+                title = json.loads(body or b"{}").get("title", "Untitled")
+                return self.create_document(title).to_json()
+            match = re.fullmatch(r"/v1/documents/([^/:]+)", path)
+            if method == "GET" and match:
+                return self.get_document(match[1]).to_json()
+            match = re.fullmatch(r"/v1/documents/([^/:]+):batchUpdate", path)
+            if method == "POST" and match:
+                document = self.get_document(match[1])
+                return document.batch_update(json.loads(body))
+            match = re.fullmatch(r"/drive/v3/files/([^/]+)/copy", path)
+            if method == "POST" and match:
+                source = self.get_document(match[1])
+                name = json.loads(body or b"{}").get("name", source.title)
+                document = self.create_document(name)
+                document.units = source.units
+                return {"id": document.document_id}
+            match = re.fullmatch(
+                r"/drive/v3/files/([^/]+)/permissions", path
+            )
+            if method == "POST" and match:
+                self.get_document(match[1])
+                permission = json.loads(body)
+                self.permissions.setdefault(match[1], []).append(permission)
+                return {"id": "anyoneWithLink", **permission}
+            if method == "POST" and path == "/upload/drive/v3/files":
+                metadata, text = parse_upload(content_type, body)
+                document = self.create_document(
+                    metadata.get("name", "Untitled"), text
+                )
+                return {"id": document.document_id}
+        raise ApiError(404, "NOT_FOUND", f"No fake for {method} {path}")
+
+
+def error_json(error):
+    """ Returns an ApiError in Google's JSON error format. """
+    return {
+        "error": {
+            "code": error.code,
+            "message": error.message,
+            "status": error.status,
+        }
+    }
+
+
+def parse_upload(content_type, body):
+    """
+    Splits a multipart Drive upload into its metadata and the text of
+    the uploaded file, with any HTML reduced to plain text
+    """
+    message = email.message_from_bytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    metadata_part, media_part = message.get_payload()
+    metadata = json.loads(metadata_part.get_payload(decode=True))
+    text = media_part.get_payload(decode=True).decode("utf-8")
+    if media_part.get_content_type() == "text/html":
+        text = re.sub(r"</(p|tr)>", "\n", text)
+        text = html.unescape(re.sub(r"<[^>]+>", "", text))
+    return metadata, text
+
+
+def make_handler(fake):
+    """
+    Returns a request handler class that serves the given fake APIs,
+    which tests can reach as its fake attribute
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.respond("GET")
+
+        def do_POST(self):
+            self.respond("POST")
+
+        def respond(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+            path = urlparse(self.path).path
+            content_type = self.headers.get("Content-Type", "")
+            try:
+                if method == "POST" and path in BATCH_PATHS:
+                    status = 200
+                    content_type, payload = fake.handle_batch(
+                        content_type, body
+                    )
+                else:
+                    status, response = 200, fake.handle(
+                        method, path, content_type, body
+                    )
+            except ApiError as error:
+                status, response = error.code, error_json(error)
+            if status != 200 or path not in BATCH_PATHS:
+                content_type = "application/json"
+                payload = json.dumps(response).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    Handler.fake = fake
+    return Handler
+
+
+def serve(host="127.0.0.1", port=8765, **faults):
+    """
+    Creates the fake API server. Call serve_forever() on the result to
+    run it.
+    """
+    return ThreadingHTTPServer(
+        (host, port), make_handler(FakeGoogle(**faults))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="average seconds added to every request",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0,
+        help="fraction of requests that fail with a 503",
+    )
+    parser.add_argument(
+        "--quota-per-minute", type=int, default=None,
+        help="requests allowed per minute before returning 429",
+    )
+    args = parser.parse_args()
+    server = serve(
+        args.host,
+        args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        quota_per_minute=args.quota_per_minute,
+    )
+    print(f"Fake Google APIs listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import fcntl
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Holds an exclusive lock on the file at path while the block runs,
+    so that session processes sharing a local file take turns with it.
+    Yields False if blocking is off and another process already holds
+    the lock.
+    """
+    with open(path, "a", encoding="utf-8") as lock_file:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
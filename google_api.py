@@ -0,0 +1,310 @@
+import json
+import os
+import random
+import threading
+import time
+from google.auth.exceptions import GoogleAuthError, TransportError
+from googleapiclient.errors import HttpError
+from httplib2 import HttpLib2Error
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from file_lock import file_lock
+from metrics import API_METRICS
+
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+"""
+HTTP statuses returned by Google APIs that are worth retrying
+"""
+
+TRANSPORT_ERRORS = (HttpError, HttpLib2Error, GoogleAuthError, OSError)
+"""
+Errors a Google API call fails with: an error response, or failing to
+reach the API or the token endpoint, such as a DNS failure or a token
+refresh that fails. ConnectionError and TimeoutError are OSErrors.
+"""
+
+DEFAULT_DEADLINE = 30.0
+"""
+Seconds a single API call, including its retries, may take in total
+"""
+
+REQUEST_TIMEOUT = 10.0
+"""
+Socket timeout in seconds for each individual HTTP request
+"""
+
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 16.0
+MAX_RETRIES = 6
+
+RATE_LIMIT_FILE = "rate_limits.json"
+"""
+File the API rate limiters keep their tokens in, so that every session
+process on the host shares one quota
+"""
+
+DOCS_READS_PER_MINUTE = int(
+    os.environ.get("TRAVEL_BUDGET_DOCS_READS_PER_MINUTE", "300")
+)
+DOCS_WRITES_PER_MINUTE = int(
+    os.environ.get("TRAVEL_BUDGET_DOCS_WRITES_PER_MINUTE", "60")
+)
+"""
+Docs API calls allowed per minute. Every session uses the same service
+account, so the defaults are Docs' per-user quotas, which are a tenth
+of its per-project ones.
+"""
+
+DRIVE_CALLS_PER_MINUTE = int(
+    os.environ.get("TRAVEL_BUDGET_DRIVE_CALLS_PER_MINUTE", "12000")
+)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        """
+        Creates a token bucket rate limiter that allows `rate` calls per
+        second on average with bursts of up to `capacity` calls
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Takes a token if one is available. Returns 0 if one was taken,
+        otherwise the seconds until one will be.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate,
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """
+        Takes a token from the bucket, waiting for one to become available.
+        Returns False if no token is available before the timeout.
+        """
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.take()
+            if not wait:
+                return True
+            if give_up_at is not None and time.monotonic() + wait > give_up_at:
+                return False
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    def __init__(self, name, rate, capacity, path=RATE_LIMIT_FILE):
+        """
+        Creates a token bucket whose tokens are kept, under the given
+        name, in a file-locked file on disk, so that every session
+        process using the file takes from the same bucket and together
+        they stay under the rate
+        """
+        super().__init__(rate, capacity)
+        self.name = name
+        self.path = path
+
+    def load(self):
+        """
+        Returns the state of every bucket in the file, or an empty dict
+        if the file is missing or unreadable
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, buckets):
+        """ Atomically replaces the file. """
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(buckets, f)
+        os.replace(temp_path, self.path)
+
+    def take(self):
+        """
+        Takes a token from the shared bucket if one is available.
+        Returns 0 if one was taken, otherwise the seconds until one
+        will be. Wall-clock time is used, as it is shared by processes.
+        """
+        with self.lock, file_lock(self.path + ".lock"):
+            buckets = self.load()
+            now = time.time()
+            state = buckets.get(
+                self.name, {"tokens": self.capacity, "updated": now}
+            )
+            tokens = min(
+                self.capacity,
+                state["tokens"] + max(0, now - state["updated"]) * self.rate,
+            )
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            buckets[self.name] = {"tokens": tokens - 1, "updated": now}
+            self.save(buckets)
+            return 0
+
+
+def per_minute_limit(name, calls_per_minute, capacity):
+    """
+    Returns a shared token bucket that never allows more than
+    calls_per_minute calls in any minute, a full burst included.
+    Bursts are kept to at most half the calls of a minute.
+    """
+    capacity = max(1, min(capacity, calls_per_minute // 2))
+    return SharedTokenBucket(
+        name, rate=(calls_per_minute - capacity) / 60, capacity=capacity
+    )
+
+
+DOCS_READ_LIMIT = per_minute_limit(
+    "docs-read", DOCS_READS_PER_MINUTE, capacity=10
+)
+DOCS_WRITE_LIMIT = per_minute_limit(
+    "docs-write", DOCS_WRITES_PER_MINUTE, capacity=5
+)
+DRIVE_LIMIT = per_minute_limit("drive", DRIVE_CALLS_PER_MINUTE, capacity=20)
+
+GOOGLE_BREAKER = CircuitBreaker(
+    failure_threshold=3, latency_threshold=5.0, reset_timeout=30.0
+)
+"""
+Shared by the Docs and Drive clients, which fail together when Google
+is having an incident
+"""
+
+
+def is_retryable(error):
+    """
+    Returns True if a failed API call may succeed when retried
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    if isinstance(error, GoogleAuthError):
+        # A refresh the token endpoint rejected, such as for a revoked
+        # key, fails the same way every time.
+        return isinstance(error, TransportError) or error.retryable
+    return isinstance(error, TRANSPORT_ERRORS)
+
+
+def is_outage(error):
+    """
+    Returns True if a failed API call counts against GOOGLE_BREAKER:
+    an error status that signals trouble on Google's side, or any
+    failure to get a response at all, including from the token
+    endpoint, whether or not it is worth retrying
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, TRANSPORT_ERRORS)
+
+
+def backoff_delay(attempt):
+    """
+    Returns a jittered exponential backoff delay for the given attempt
+    """
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+
+def error_status(error):
+    """
+    Returns the HTTP status of a failed API call, or the name of the
+    error if the call got no response
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status
+    return type(error).__name__
+
+
+def payload_size(request):
+    """ Returns the size in bytes of the request's body. """
+    body = getattr(request, "body", None) or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return len(body)
+
+
+def dispatched(dispatcher, request, timeout):
+    """
+    Sends a request through a BatchDispatcher and returns its response.
+    If the response does not come within the timeout, the request is
+    taken back out of the queue so it is never sent after the caller
+    has retried it or given up. Once its batch is being sent, the
+    response is waited for instead, however long it takes.
+    """
+    future = dispatcher.submit(request)
+    try:
+        return future.result(timeout=max(0, timeout))
+    except TimeoutError:
+        if future.cancel():
+            raise
+    return future.result()
+
+
+def execute(request, limiter, deadline=DEFAULT_DEADLINE, dispatcher=None):
+    """
+    Executes a Google API request once a token is available from the
+    limiter, retrying retryable failures with jittered exponential
+    backoff until the deadline passes. Raises CircuitOpenError without
+    calling the API while GOOGLE_BREAKER is open. If a BatchDispatcher
+    is given, the request is sent as part of its next HTTP batch.
+    Every attempt is recorded in API_METRICS under the request's method.
+    """
+    operation = getattr(request, "methodId", None) or "unknown"
+    size = payload_size(request)
+    give_up_at = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        if not GOOGLE_BREAKER.allow_request():
+            API_METRICS.record_call(operation, "circuit_open")
+            raise CircuitOpenError("Google APIs are unavailable")
+        waiting = time.monotonic()
+        acquired = limiter.acquire(timeout=give_up_at - waiting)
+        API_METRICS.record_wait(operation, time.monotonic() - waiting)
+        if not acquired:
+            API_METRICS.record_call(operation, "rate_limited")
+            raise TimeoutError(
+                f"Rate limit wait exceeded the {deadline}s deadline"
+            )
+        started = time.monotonic()
+        try:
+            if dispatcher is None:
+                response = request.execute()
+            else:
+                response = dispatched(
+                    dispatcher, request, give_up_at - time.monotonic()
+                )
+        except TRANSPORT_ERRORS as error:
+            latency = time.monotonic() - started
+            API_METRICS.record_call(
+                operation, error_status(error), latency, size
+            )
+            if is_outage(error):
+                GOOGLE_BREAKER.record_failure()
+            else:
+                GOOGLE_BREAKER.record_success(latency)
+            if not is_retryable(error) or attempt >= MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            if time.monotonic() + delay > give_up_at:
+                raise
+            API_METRICS.record_retry(operation)
+            time.sleep(delay)
+            attempt += 1
+        else:
+            latency = time.monotonic() - started
+            API_METRICS.record_call(operation, 200, latency, size)
+            GOOGLE_BREAKER.record_success(latency)
+            return response
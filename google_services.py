@@ -0,0 +1,191 @@
+import json
+import os
+import pkgutil
+import threading
+import httplib2
+from googleapiclient.discovery import build_from_document
+from google.auth.credentials import AnonymousCredentials
+from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+from google_api import REQUEST_TIMEOUT
+from http_pool import PooledHttp
+from batch_dispatcher import BatchDispatcher
+from token_cache import SharedTokenCredentials
+
+
+SCOPE = [
+    "https://www.googleapis.com/auth/documents",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive",
+]
+
+CREDENTIALS_FILE = "creds.json"
+
+API_ENDPOINT = os.environ.get("GOOGLE_API_ENDPOINT")
+"""
+Base URL of a stand-in for the Google APIs, such as fake_google.py.
+When set, no credentials are loaded and every client talks to it.
+"""
+
+HTTP_POOL_SIZE = 8
+
+BATCH_WINDOW = float(os.environ.get("GOOGLE_BATCH_WINDOW", "0"))
+"""
+Seconds that writes from different sessions are held so they can be
+sent to Google together in one HTTP batch. 0 sends every call on its own.
+"""
+
+COLLECTIONS = {"docs": ["documents"], "drive": ["files", "permissions"]}
+"""
+Collections of each API that the app uses. googleapiclient rebuilds a
+collection, including rendering docstrings for all of its methods,
+every time it is accessed, which costs tens of milliseconds per call,
+so each is built once and reused.
+"""
+
+_services = {}
+_dispatchers = {}
+_http = []
+_credentials = []
+_lock = threading.Lock()
+
+
+def get_credentials():
+    """
+    Loads the service account credentials the first time they are
+    needed and returns the same scoped credentials afterwards. Access
+    tokens are shared with other session processes through the token
+    cache.
+    """
+    with _lock:
+        if not _credentials and API_ENDPOINT:
+            _credentials.append(AnonymousCredentials())
+        if not _credentials:
+            creds = service_account.Credentials.from_service_account_file(
+                CREDENTIALS_FILE,
+                scopes=SCOPE,
+            )
+            _credentials.append(
+                SharedTokenCredentials(creds.with_scopes(SCOPE))
+            )
+        return _credentials[0]
+
+
+def authorized_http():
+    """
+    Returns an authorized HTTP transport whose requests time out
+    instead of hanging the session
+    """
+    return AuthorizedHttp(
+        get_credentials(), http=httplib2.Http(timeout=REQUEST_TIMEOUT)
+    )
+
+
+def shared_http():
+    """
+    Returns the pooled, keep-alive transport shared by every client
+    and thread in the process
+    """
+    credentials = get_credentials()
+    with _lock:
+        if not _http:
+            _http.append(
+                PooledHttp(
+                    authorized_http,
+                    size=HTTP_POOL_SIZE,
+                    credentials=credentials,
+                )
+            )
+        return _http[0]
+
+
+def get_service(name, version):
+    """
+    Builds a Google API client the first time it is requested and
+    returns the cached client on every later call. All clients share
+    one thread-safe transport, so they can be used from any thread.
+    The discovery document bundled with googleapiclient is used so
+    that building a client never makes a network request.
+    """
+    key = (name, version)
+    with _lock:
+        service = _services.get(key)
+    if service is None:
+        if API_ENDPOINT:
+            service = build_from_endpoint(name, version, API_ENDPOINT)
+        else:
+            service = build_from_document(
+                discovery_document(name, version), http=shared_http()
+            )
+        cache_collections(service, COLLECTIONS.get(name, []))
+        with _lock:
+            service = _services.setdefault(key, service)
+    return service
+
+
+def discovery_document(name, version):
+    """
+    Returns the discovery document for an API that is bundled with
+    googleapiclient. It is read through the package's loader rather
+    than from a path, so it is also found inside a zipapp bundle.
+    """
+    return pkgutil.get_data(
+        "googleapiclient.discovery_cache", f"documents/{name}.{version}.json"
+    ).decode("utf-8")
+
+
+def cache_collections(service, names):
+    """
+    Replaces each named collection accessor on the client with one that
+    returns a single prebuilt collection
+    """
+    for name in names:
+        collection = getattr(service, name)()
+        setattr(service, name, lambda collection=collection: collection)
+
+
+def build_from_endpoint(name, version, endpoint):
+    """
+    Builds a client from the bundled discovery document with its root
+    URL pointed at another server, so that regular, upload and batch
+    requests all go to that server
+    """
+    discovery = json.loads(discovery_document(name, version))
+    discovery["rootUrl"] = f"{endpoint.rstrip('/')}/"
+    return build_from_document(discovery, http=shared_http())
+
+
+def docs_service():
+    """ Returns the shared Google Docs v1 client. """
+    return get_service("docs", "v1")
+
+
+def drive_service():
+    """ Returns the shared Google Drive v3 client. """
+    return get_service("drive", "v3")
+
+
+def get_dispatcher(name, version):
+    """
+    Returns the process-wide batch dispatcher for an API, or None if
+    batching is turned off
+    """
+    if BATCH_WINDOW <= 0:
+        return None
+    service = get_service(name, version)
+    with _lock:
+        dispatcher = _dispatchers.get((name, version))
+        if dispatcher is None:
+            dispatcher = BatchDispatcher(service, window=BATCH_WINDOW)
+            _dispatchers[(name, version)] = dispatcher
+    return dispatcher
+
+
+def docs_dispatcher():
+    """ Returns the Docs batch dispatcher, or None if it is off. """
+    return get_dispatcher("docs", "v1")
+
+
+def drive_dispatcher():
+    """ Returns the Drive batch dispatcher, or None if it is off. """
+    return get_dispatcher("drive", "v3")
@@ -0,0 +1,41 @@
+import queue
+
+
+class PooledHttp:
+    def __init__(self, make_http, size=8, credentials=None):
+        """
+        A thread-safe stand-in for httplib2.Http that can be shared by
+        every API client and background thread. Each request borrows an
+        idle transport from the pool, so its kept-alive connections are
+        reused instead of paying a new TLS handshake. make_http is
+        called to create transports as they are needed, and at most
+        size idle transports are kept.
+        """
+        self.make_http = make_http
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.credentials = credentials
+
+    def request(self, *args, **kwargs):
+        """
+        Makes a request on a pooled transport, taking the same
+        arguments as httplib2.Http.request
+        """
+        try:
+            http = self.idle.get_nowait()
+        except queue.Empty:
+            http = self.make_http()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            try:
+                self.idle.put_nowait(http)
+            except queue.Full:
+                http.close()
+
+    def close(self):
+        """ Closes every idle transport's connections. """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
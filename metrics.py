@@ -0,0 +1,429 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from file_lock import file_lock
+
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+"""
+Upper bounds in seconds of the buckets API call latencies are counted in
+"""
+
+PAYLOAD_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+"""
+Upper bounds in bytes of the buckets request payload sizes are counted in
+"""
+
+METRICS_DIR = os.environ.get("TRAVEL_BUDGET_METRICS_DIR")
+"""
+Directory the Prometheus text file and the session summaries are written
+to. Metrics are only recorded in memory when it is not set.
+"""
+
+DUMP_INTERVAL = float(os.environ.get("TRAVEL_BUDGET_METRICS_INTERVAL", "15"))
+"""
+Seconds between rewrites of the Prometheus text file
+"""
+
+EXITED_FILE = "exited.prom"
+"""
+Prometheus text file holding the summed metrics of every process that
+has ended, so that the directory does not gain a file per session
+"""
+
+EXITED_STATE = ".exited.json"
+
+SESSION_METRICS = contextvars.ContextVar("session_metrics", default=None)
+"""
+Metrics of the one session that the running task or thread is working
+for, in a process that hosts many, so that each session's summary holds
+only its own Google API calls
+"""
+
+
+def for_this_session(function):
+    """
+    Returns the function bound to the calling session, so that the
+    Google API calls it makes from another thread, such as an executor
+    or a writer's worker, are recorded in SESSION_METRICS
+    """
+    context = contextvars.copy_context()
+
+    def in_session(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so
+        # each call runs in a copy of it.
+        return context.copy().run(function, *args, **kwargs)
+
+    return in_session
+
+
+def replace_file(path, text):
+    """
+    Writes text to the file at path, replacing it in one step so a
+    collector never reads half a file
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        """
+        Counts observed values in cumulative buckets, as a Prometheus
+        histogram does
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """ Adds a value to the histogram. """
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket the q quantile falls in,
+        or the largest value seen if it is above every bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return self.max
+
+    def prometheus_lines(self, name, labels):
+        """
+        Returns the histogram's samples in the Prometheus text format
+        """
+        lines = [
+            f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+    def state(self):
+        """ Returns the counts as a dict that can be stored as JSON. """
+        return {
+            "counts": self.counts,
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+        }
+
+    def add_state(self, state):
+        """ Adds counts returned by state() to the histogram. """
+        self.counts = [
+            count + added for count, added in zip(self.counts, state["counts"])
+        ]
+        self.count += state["count"]
+        self.sum += state["sum"]
+        self.max = max(self.max, state["max"])
+
+
+class OperationMetrics:
+    def __init__(self):
+        """
+        Holds the metrics recorded for one type of API operation
+        """
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.payload = Histogram(PAYLOAD_BUCKETS)
+        self.statuses = {}
+        self.retries = 0
+        self.limiter_wait = 0.0
+
+    def summary(self):
+        """ Returns the metrics as a dict for the session summary. """
+        return {
+            "calls": self.latency.count,
+            "statuses": self.statuses,
+            "retries": self.retries,
+            "latency_seconds": {
+                "total": round(self.latency.sum, 6),
+                "mean": round(
+                    self.latency.sum / max(1, self.latency.count), 6
+                ),
+                "p50": self.latency.quantile(0.5),
+                "p95": self.latency.quantile(0.95),
+                "max": round(self.latency.max, 6),
+            },
+            "payload_bytes": {
+                "total": int(self.payload.sum),
+                "max": int(self.payload.max),
+            },
+            "rate_limit_wait_seconds": round(self.limiter_wait, 6),
+        }
+
+    def state(self):
+        """ Returns the metrics as a dict that can be stored as JSON. """
+        return {
+            "latency": self.latency.state(),
+            "payload": self.payload.state(),
+            "statuses": self.statuses,
+            "retries": self.retries,
+            "limiter_wait": self.limiter_wait,
+        }
+
+    def add_state(self, state):
+        """ Adds metrics returned by state() to these. """
+        self.latency.add_state(state["latency"])
+        self.payload.add_state(state["payload"])
+        for status, count in state["statuses"].items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.retries += state["retries"]
+        self.limiter_wait += state["limiter_wait"]
+
+
+class ApiMetrics:
+    def __init__(self):
+        """
+        Records the latency, payload size, status and retries of every
+        Google API call, keyed by operation, e.g.
+        docs.documents.batchUpdate. Every call from the process is
+        recorded, whichever thread makes it.
+        """
+        self.operations = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.retired = False
+
+    def operation(self, name):
+        """
+        Returns the metrics for an operation. Must be called holding
+        the lock.
+        """
+        if name not in self.operations:
+            self.operations[name] = OperationMetrics()
+        return self.operations[name]
+
+    def record_call(self, name, status, latency=None, payload_size=None):
+        """
+        Records one attempt at an operation. status is the HTTP status,
+        or the name of the error for calls that got no response.
+        Attempts refused before reaching the API have no latency.
+        """
+        with self.lock:
+            operation = self.operation(name)
+            status = str(status)
+            operation.statuses[status] = operation.statuses.get(status, 0) + 1
+            if latency is not None:
+                operation.latency.observe(latency)
+            if payload_size is not None:
+                operation.payload.observe(payload_size)
+        session = self.session_metrics()
+        if session is not None:
+            session.record_call(name, status, latency, payload_size)
+
+    def record_retry(self, name):
+        """ Records that a failed attempt at an operation is retried. """
+        with self.lock:
+            self.operation(name).retries += 1
+        session = self.session_metrics()
+        if session is not None:
+            session.record_retry(name)
+
+    def record_wait(self, name, seconds):
+        """ Records time spent waiting for the rate limiter. """
+        with self.lock:
+            self.operation(name).limiter_wait += seconds
+        session = self.session_metrics()
+        if session is not None:
+            session.record_wait(name, seconds)
+
+    def session_metrics(self):
+        """
+        Returns the metrics of the session the current call is made
+        for, if it has its own, which the call is also recorded in
+        """
+        metrics = SESSION_METRICS.get()
+        return None if metrics is self else metrics
+
+    def state(self):
+        """
+        Returns the metrics of every operation as a dict that can be
+        stored as JSON
+        """
+        with self.lock:
+            return {
+                name: operation.state()
+                for name, operation in self.operations.items()
+            }
+
+    def add_state(self, operations):
+        """ Adds metrics returned by state() to these. """
+        with self.lock:
+            for name, state in operations.items():
+                self.operation(name).add_state(state)
+
+    def to_prometheus(self, process=None):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        Samples are labelled with the process ID, or the given process
+        label, so that the files of many session processes can be
+        collected side by side.
+        """
+        process = f'process="{process or os.getpid()}"'
+        latency = []
+        payload = []
+        calls = []
+        retries = []
+        waits = []
+        with self.lock:
+            for name, operation in sorted(self.operations.items()):
+                labels = f'{process},operation="{name}"'
+                latency.extend(operation.latency.prometheus_lines(
+                    "travel_budget_api_request_duration_seconds", labels
+                ))
+                payload.extend(operation.payload.prometheus_lines(
+                    "travel_budget_api_request_size_bytes", labels
+                ))
+                calls.extend(
+                    f'travel_budget_api_requests_total{{{labels},'
+                    f'status="{status}"}} {count}'
+                    for status, count in sorted(operation.statuses.items())
+                )
+                retries.append(
+                    f"travel_budget_api_retries_total{{{labels}}} "
+                    f"{operation.retries}"
+                )
+                waits.append(
+                    f"travel_budget_api_rate_limit_wait_seconds_total"
+                    f"{{{labels}}} {operation.limiter_wait}"
+                )
+        sections = [
+            ("travel_budget_api_request_duration_seconds", "histogram",
+             "Latency of each Google API call attempt.", latency),
+            ("travel_budget_api_request_size_bytes", "histogram",
+             "Size of each Google API request body.", payload),
+            ("travel_budget_api_requests_total", "counter",
+             "Google API call attempts by response status.", calls),
+            ("travel_budget_api_retries_total", "counter",
+             "Google API call attempts that were retried.", retries),
+            ("travel_budget_api_rate_limit_wait_seconds_total", "counter",
+             "Time spent waiting for the client-side rate limiter.", waits),
+        ]
+        lines = []
+        for name, kind, description, samples in sections:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def summary(self, **extra):
+        """
+        Returns a summary of the process's API calls as a dict, with
+        any extra fields added
+        """
+        with self.lock:
+            operations = {
+                name: operation.summary()
+                for name, operation in sorted(self.operations.items())
+            }
+        return {
+            "started": self.started,
+            "duration_seconds": round(time.time() - self.started, 6),
+            **extra,
+            "operations": operations,
+        }
+
+    def write_prometheus(self, directory=METRICS_DIR):
+        """
+        Writes the metrics to <pid>.prom in the directory, replacing the
+        file in one step so a collector never reads half a file. Once
+        the process has retired its metrics, nothing is written.
+        """
+        path = os.path.join(directory, f"{os.getpid()}.prom")
+        with self.write_lock:
+            if self.retired:
+                return None
+            os.makedirs(directory, exist_ok=True)
+            replace_file(path, self.to_prometheus())
+        return path
+
+    def retire(self, directory=METRICS_DIR):
+        """
+        Adds the process's metrics to those of every process that has
+        ended, kept in exited.prom under process="exited", and removes
+        the process's own <pid>.prom. Otherwise, with a process per
+        session, the directory would keep a file for every session
+        ever run and a collector would go on summing them. Called once,
+        as the process ends.
+        """
+        with self.write_lock:
+            if self.retired:
+                return
+            self.retired = True
+            os.makedirs(directory, exist_ok=True)
+            state_path = os.path.join(directory, EXITED_STATE)
+            with file_lock(f"{state_path}.lock"):
+                exited = ApiMetrics()
+                try:
+                    with open(state_path, "r", encoding="utf-8") as f:
+                        exited.add_state(json.load(f))
+                except (OSError, ValueError):
+                    pass
+                exited.add_state(self.state())
+                replace_file(state_path, json.dumps(exited.state()))
+                replace_file(
+                    os.path.join(directory, EXITED_FILE),
+                    exited.to_prometheus(process="exited"),
+                )
+            try:
+                os.remove(os.path.join(directory, f"{os.getpid()}.prom"))
+            except FileNotFoundError:
+                pass
+
+    def write_summary(self, name, directory=METRICS_DIR, **extra):
+        """
+        Writes the JSON summary to <name>.json in the directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(**extra), f, indent=2)
+        return path
+
+    def dump_periodically(
+        self, directory=METRICS_DIR, interval=DUMP_INTERVAL
+    ):
+        """
+        Rewrites the Prometheus text file every interval seconds from a
+        background thread until the process retires its metrics
+        """
+        def dump():
+            while not self.retired:
+                time.sleep(interval)
+                try:
+                    self.write_prometheus(directory)
+                except OSError:
+                    continue
+
+        thread = threading.Thread(
+            target=dump, name="metrics-dump", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+API_METRICS = ApiMetrics()
+"""
+Metrics for every Google API call made by the process
+"""
@@ -0,0 +1,539 @@
+"""
+The Travel Budget Planner session: its prompts, budget logic and the
+summary it writes to a sink.
+
+The flow of a session is written as generators. Wherever the session
+waits on the user or on slow I/O it yields an Ask, Wait or Block
+request to whatever is driving it, and resumes with the result, so the
+same session can be driven from a terminal with run_session or by any
+other driver. Importing this module has no side effects, and only
+loads what the welcome screen needs.
+"""
+import os
+import time
+from concurrent.futures import Future
+from rich.padding import Padding
+from rich.console import Console
+from expenses import Expense
+
+
+INTRO_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "intro.txt"
+)
+"""
+Introduction shown at the start of every session. When the app runs
+from a zipapp bundle this path is inside the archive.
+"""
+
+CATEGORIES = [
+    "Flights/Transport",
+    "Accommodation",
+    "Excursions",
+    "Miscellaneous",
+]
+
+STYLED_CATEGORIES = [
+    "[color(57)]✈️ Flights/Transport[/color(57)]",
+    "[color(57)]🏨 Accommodation[/color(57)]",
+    "[color(57)]🚤 Excursions[/color(57)]",
+    "[color(57)]✨ Miscellaneous[/color(57)]",
+]
+
+welcome = Padding(
+    (
+        "[u]:airplane_departure: Welcome to your Travel Budget Planner "
+        ":money_with_wings:[/u]"
+    ),
+    1,
+)
+
+
+def get_content(file):
+    """
+    Reads the content of a file shipped with the app and returns it as
+    a string. The file is read through this module's loader, so it is
+    found inside a zipapp bundle as well as on disk.
+    """
+    return __loader__.get_data(file).decode("utf-8")
+
+
+# Summary formatting
+
+def initial_details_text(budget, duration, spending_money):
+    """
+    Returns the summary of the travel details
+    """
+    return (
+        f"\nYour travel budget is £{budget:,.2f}, you plan to travel for "
+        f"{duration} days and ideally you would like to have £"
+        f"{spending_money:,.2f} to spend per day."
+    )
+
+
+def expense_text(expense):
+    """
+    Returns the summary of an added expense
+    """
+    return (
+        f"\nYou have added an expense of £{expense.cost:,.2f} for "
+        f"{expense.description} under the category {expense.category}."
+    )
+
+
+def final_summary_text(total_expenses, remaining_budget, duration):
+    """
+    Returns the final summary of the expenses
+    """
+    return (
+        f"\nYour total expenses are £{total_expenses:,.2f}.\n"
+        f"\nYou have £{remaining_budget:,.2f} left to "
+        f"spend on your trip.\n"
+        f"\nYou can spend £{remaining_budget / duration:,.2f}"
+        f" per day.\n"
+    )
+
+
+def expense_summary_rows(expense_totals):
+    """
+    Returns the running total per category as rows of a table
+    """
+    rows = [["Category", "Running Total"]]
+    for cat, total in expense_totals.items():
+        rows.append([cat, f"£{total:,.2f}"])
+    return rows
+
+
+# Requests a session makes of its driver
+
+class Ask:
+    def __init__(self, prompt):
+        """
+        Asks the user for a line of input after showing the prompt,
+        given as Rich markup. The driver resumes the session with the
+        line.
+        """
+        self.prompt = prompt
+
+    def run(self, console):
+        return console.input(self.prompt)
+
+
+class Wait:
+    def __init__(self, seconds, status):
+        """
+        Pauses the session for a number of seconds while a status
+        spinner is shown
+        """
+        self.seconds = seconds
+        self.status = status
+
+    def run(self, console):
+        with console.status(self.status, spinner="aesthetic", speed=1.0):
+            time.sleep(self.seconds)
+
+
+class Block:
+    def __init__(self, function):
+        """
+        Calls a function that may block on network or disk I/O. The
+        driver resumes the session with its result.
+        """
+        self.function = function
+
+    def run(self, console):
+        return self.function()
+
+
+def run_session(flow, console):
+    """
+    Drives a session flow to the end by carrying out its requests on
+    the console, blocking the calling thread, and returns its result
+    """
+    reply = None
+    try:
+        while True:
+            reply = flow.send(reply).run(console)
+    except StopIteration as stop:
+        return stop.value
+
+
+class BudgetSession:
+    def __init__(self, sink, console=None, error_console=None):
+        """
+        Holds the state of one user's session. Output goes to the
+        session's own consoles and the summary to its sink, so many
+        sessions can run in one process. The sink may be a future
+        resolving to the sink, so the session can start while the sink
+        is still being opened.
+        """
+        self.opened_sink = sink
+        self.console = console or Console()
+        self.error_console = error_console or Console(
+            stderr=True, style="bold red"
+        )
+
+    @property
+    def sink(self):
+        """ Returns the sink, waiting for it if it is being opened. """
+        if isinstance(self.opened_sink, Future):
+            return self.opened_sink.result()
+        return self.opened_sink
+
+    def run(self):
+        """
+        The flow of a whole session, from the welcome message to the
+        link to the summary
+        """
+        console = self.console
+        console.print(welcome, style="bold #15E6E4", justify="center")
+        begin = get_content(INTRO_FILE)
+        console.print(begin, style="color(195)")
+        console.rule("")
+        budget, duration, spending_money = yield from self.display_initial()
+        console.rule("")
+        console.print(
+            (
+                "\nThe next set of questions will be about your expenses "
+                "such as hotels, flights or activities such as boat trips "
+                "or a tour of a vineyard."
+            ),
+            style="color(10)",
+            )
+        console.print(
+            "You can enter multiple expenses if you wish.\n",
+            style="color(10)",
+            )
+        yield from self.track_expenses(budget, duration, spending_money)
+
+    def get_input(
+        self,
+        question,
+        value_type,
+        min_value=None,
+        error="Please enter a valid number greater than 0",
+        show_symbol=False
+    ):
+        """
+        This function gets input from the user and
+        throws an error if the input is not valid
+        """
+        while True:
+            self.console.print(f"[color(166)]{question}[/color(166)]")
+            currency = "£ " if show_symbol else ""
+            user_input = (yield Ask(f"> {currency} ")).strip()
+            try:
+                value = value_type(user_input)
+                if (
+                    (value_type == str and user_input.isdigit())
+                    or (
+                        isinstance(value, (int, float))
+                        and not user_input.replace('.', '', 1).isdigit()
+                    )
+                    or (
+                        isinstance(value, (int, float))
+                        and value <= min_value
+                    )
+                ):
+                    self.error_console.print(f"\n{error}\n")
+                    continue
+                return value
+            except ValueError:
+                self.error_console.print(f"\n Invalid input - {error}")
+
+    def initial_questions(self):
+        """
+        This function asks the user for their travel budget, duration,
+        and spending money whilst using the get_input function.
+        """
+        budget = yield from self.get_input(
+            question="What is your travel budget?",
+            value_type=float,
+            error=(
+                "Please enter a [underline]number[/underline] greater than 0"
+            ),
+            min_value=0,
+            show_symbol=True,
+        )
+        duration = yield from self.get_input(
+            question="What is the length of your travel in days? ",
+            value_type=int,
+            error=(
+                "Please enter a [underline]number[/underline] greater than 0"
+            ),
+            min_value=0,
+            show_symbol=False,
+        )
+        spending_money = yield from self.get_input(
+            question="How much spending money do you require per day?",
+            value_type=float,
+            error=(
+                "Please enter a [underline]number[/underline] greater than 0"
+            ),
+            min_value=0,
+            show_symbol=True,
+        )
+        return budget, duration, spending_money
+
+    def display_initial(self):
+        """
+        This function displays the initial travel details
+        and asks the user to confirm them.
+        a Rich display status bar is used to identify
+        when a process is running to display a custom
+        statement
+        """
+        self.console.print(
+            "\nThe first set of questions will assist the app in "
+            "understanding your criteria and requirements for this trip.\n"
+            "\nLet's begin!\n",
+            style="color(10)"
+        )
+        while True:
+            budget, duration, spending_money = (
+                yield from self.initial_questions()
+            )
+            self.console.print("")
+            yield from self.loading_widget()
+            display_initial_text = initial_details_text(
+                budget, duration, spending_money
+            )
+            self.console.print(display_initial_text, style="color(226) bold")
+
+            if (yield from self.confirm()):
+                yield Block(lambda: self.sink.append(
+                    display_initial_text, section="initial_details"
+                ))
+                return budget, duration, spending_money
+            else:
+                self.console.print("\nLet's try again.")
+
+    def confirm(self):
+        """
+        This function asks the user to confirm if their travel details are
+        correct. Returns True if they confirm (Y), False if they want to
+        restart (N).
+        """
+        while True:
+            confirmation = (yield Ask(
+                "\n\n[color(166)]Are these details correct?[/color(166)] "
+                "[bold color(50)](Y/N):[/bold color(50)] "
+            )).strip().lower()
+
+            if confirmation in ["y", "n"]:
+                return confirmation == "y"  # True for "Y", False for "N"
+
+            self.error_console.print(
+                "\n Invalid input. Please enter 'Y' for Yes or 'N' for No.",
+                style="bold red"
+                )
+
+    def subsequent_questions(self):
+        """
+        This function gets the type of expense from the user, cost
+        and category of the expense.
+        It also asks for confirmation before proceeding.
+        """
+        while True:
+            description = yield from self.get_input(
+                question=(
+                    "\nEnter a description of the expense "
+                    "e.g boat trip, booking.com, etc: "
+                ),
+                value_type=str,
+                error="Invalid input - Please enter a valid type of expense",
+                show_symbol=False,
+            )
+            cost = yield from self.get_input(
+                question="\nEnter the amount of the expense e.g 100.00:",
+                value_type=float,
+                error="Please enter a valid amount\n",
+                min_value=0,
+                show_symbol=True,
+            )
+            while True:
+                self.console.print(
+                    "\n[color(50)]Please select a category: [/color(50)]\n"
+                )
+                for i, category_option in enumerate(STYLED_CATEGORIES):
+                    self.console.print(f"  {i + 1}. {category_option}")
+                value_range = f"[1 - {len(CATEGORIES)}]"
+                try:
+                    selected_index = int((yield Ask(
+                        f"\n[color(50)]Enter a category number "
+                        f"{value_range}: [/color(50)]"
+                    ))) - 1
+                    if selected_index not in range(len(CATEGORIES)):
+                        raise ValueError
+                    break
+                except ValueError:
+                    self.error_console.print(
+                        f"\nInvalid input. Please enter a number between "
+                        f"1 and {len(CATEGORIES)}.\n",
+                        style="bold red"
+                    )
+            expense = Expense(description, cost, CATEGORIES[selected_index])
+            self.console.print(expense_text(expense), style="color(226) bold")
+            if (yield from self.confirm()):
+                return expense
+            else:
+                self.console.print(
+                    "\nLet's try entering that expense again.",
+                    style="color(166)"
+                )
+
+    def track_expenses(self, budget, duration, spending_money):
+        """
+        This function tracks the expenses
+        """
+        expense_totals = {category: 0 for category in CATEGORIES}
+        total_expenses = 0
+        expense_summaries = []
+        while True:
+            expense = yield from self.subsequent_questions()
+            expense_totals[expense.get_category()] += expense.cost
+            total_expenses += expense.cost
+
+            expense_summaries.append(f"{expense_text(expense)}\n")
+            yield from self.display_added_expense(
+                expense_summaries, expense, expense_totals
+            )
+            if not (yield from self.add_more_expenses()):
+                break
+        yield from self.final_summary(
+            budget, duration, spending_money, total_expenses
+        )
+
+    def display_added_expense(
+                self, expense_summaries, expense, expense_totals
+    ):
+        """
+        This function displays a summary of the expense added
+        and also updates the running total per
+        category. The expenses and running totals in the summary
+        are updated in place.
+        """
+        # Table is only needed once the first expense is added, so it is
+        # not loaded before the welcome screen.
+        from rich.table import Table
+        from rich import box
+        self.console.rule("")
+        self.console.print("")
+        yield from self.loading_widget()
+        table = Table(
+            title="\n[color(51)]Expense Summary[/color(51)]",
+            box=box.ASCII_DOUBLE_HEAD
+        )
+        table.add_column("Category", justify="left")
+        table.add_column("Running Total", justify="right")
+        for cat, total in expense_totals.items():
+            table.add_row(f"{cat}", f"£{total:,.2f}", style="color(226)")
+        self.console.print(table)
+        yield Block(lambda: self.sink.replace_section(
+            "expenses", [("text", "".join(expense_summaries))]
+        ))
+        yield Block(lambda: self.sink.replace_section(
+            "expense_summary",
+            [
+                ("text", "\nExpense Summary\n"),
+                ("table", expense_summary_rows(expense_totals)),
+            ],
+        ))
+
+    def loading_widget(self):
+        """
+        This function displays a loading widget
+        """
+        yield Wait(2, "\n[bold green]Loading...")
+
+    def add_more_expenses(self):
+        """
+        This function asks the user if they want to add more expenses
+        """
+        while True:
+            add_more = (yield Ask(
+                "\n[color(166)]Do you want to add another expense?"
+                "[/color(166)\n][bold color(50)] (Y/N):[/bold color(50)] "
+            )).strip().lower()
+            if add_more == "y":
+                return True
+            elif add_more == "n":
+                return False
+            else:
+                self.error_console.print(
+                    "\nInvalid input. Please enter 'Y'"
+                    "for Yes or 'N' for No.\n", style="bold red"
+                )
+
+    def final_summary(
+        self, budget, duration, spending_money, total_expenses
+    ):
+        """
+        This function displays the final summary of the expenses and then
+        appends the summary to Google Docs. The summary is uploaded in the
+        background while it is displayed, and the link is only shown once
+        every write to the document has finished.
+        """
+        console = self.console
+        console.print("")
+        yield from self.loading_widget()
+        remaining_budget = budget - total_expenses
+        summary_text = final_summary_text(
+            total_expenses, remaining_budget, duration
+        )
+        yield Block(lambda: self.sink.replace_section(
+            "final_summary", [("text", f"{summary_text}\n")]
+        ))
+        yield Block(lambda: self.sink.flush())
+        console.rule("")
+        console.print(
+            summary_text,
+            style="color(226)",
+        )
+        self.exit_message(remaining_budget, duration, spending_money)
+        link = yield Block(self.close_sink)
+        if link is None:
+            console.print(
+                "\nGoogle Docs cannot be reached right now, so your "
+                "summary has been kept and will be uploaded to Google "
+                "Docs once it is back.",
+                style="bold color(51)",
+            )
+        else:
+            console.print(
+                f"\nYour unique summary has been saved here: {link}",
+                style="bold color(51)",
+            )
+        console.print("")
+        console.print("")
+        console.print(
+            "\nThank you for using the Travel Budget Planner!"
+            "\nWe hope to see you again soon!\n",
+            style="bold color(69)",
+            justify="center",
+        )
+
+    def close_sink(self):
+        """
+        Writes the rest of the summary and returns where it was saved,
+        or None if it is kept to be uploaded later
+        """
+        self.sink.close()
+        return self.sink.link
+
+    def exit_message(self, remaining_budget, duration, spending_money):
+        """
+        This function displays the final message and conclusion
+        of the programme.
+        """
+        remaining_budget_per_day = remaining_budget / duration
+        if remaining_budget_per_day > spending_money:
+            self.console.print(
+                "\nPack your bags and get ready for your trip! 🧳 ",
+                style="bold color(10)",
+            )
+        else:
+            self.console.print(
+                "\nUnfortunately, your expenses "
+                "have exceeded your budget. ",
+                style="bold color(196)",
+            )
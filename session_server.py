@@ -0,0 +1,290 @@
+"""
+Hosts many Travel Budget Planner sessions in one process. Each TCP
+connection is a terminal running one session as a coroutine, so a
+connection costs a few KB rather than a Python interpreter, and
+blocking work and writes to Google Docs are made on threads shared by
+all sessions. The web front end proxies each websocket's bytes to a
+connection here.
+
+Start it with e.g.
+    python3 session_server.py --port 8700
+"""
+import argparse
+import asyncio
+import codecs
+import os
+from concurrent.futures import ThreadPoolExecutor
+from rich.console import Console
+from rich.live import Live
+from rich.spinner import Spinner
+from session import Ask, Wait, Block, BudgetSession
+from run import (
+    SINK, DEAD_LETTERS, make_doc_pool, open_sink, pending_export
+)
+from metrics import (
+    API_METRICS, METRICS_DIR, SESSION_METRICS, ApiMetrics, for_this_session
+)
+from google_services import docs_service
+
+
+SESSION_HOST = os.environ.get("TRAVEL_BUDGET_SESSION_HOST", "127.0.0.1")
+SESSION_PORT = int(os.environ.get("TRAVEL_BUDGET_SESSION_PORT", "8700"))
+
+SESSION_THREADS = 8
+"""
+Threads shared by all sessions for blocking work, such as fetching a
+document from the pool or closing a sink
+"""
+
+WRITE_THREADS = 8
+"""
+Threads shared by all sessions' document writers for their writes to
+Google Docs, kept apart from SESSION_THREADS as a session waits on one
+of those for its writes to finish
+"""
+
+RETRY_INTERVAL = 60.0
+"""
+Seconds between retries of failed writes and of uploads of summaries
+kept while Google could not be reached
+"""
+
+TERMINAL_WIDTH = 80
+TERMINAL_HEIGHT = 24
+SPINNER_INTERVAL = 0.1
+
+ERASE = "\b \b"
+"""
+Echoed to remove the last character typed from the terminal
+"""
+
+
+class Terminal:
+    def __init__(self, reader, writer):
+        """
+        A line-buffered terminal over a raw byte stream from a browser
+        terminal. Does what a pseudo-terminal's line discipline would:
+        echoes what is typed, handles backspace and turns newlines in
+        the output into carriage return and line feed. Output is
+        buffered by the writer until drained.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.typed = ""
+        self.last = ""
+
+    def write(self, text):
+        """ Writes output, as a file would for a Rich Console. """
+        self.writer.write(text.replace("\n", "\r\n").encode("utf-8"))
+        return len(text)
+
+    def flush(self):
+        """
+        Does nothing, as output is sent when the terminal is drained
+        """
+
+    def isatty(self):
+        return True
+
+    async def drain(self):
+        """ Waits until buffered output has been sent. """
+        await self.writer.drain()
+
+    async def readline(self):
+        """
+        Reads a line typed by the user, without its line ending.
+        Raises EOFError if the connection closes or the user presses
+        Ctrl-C or Ctrl-D on an empty line.
+        """
+        line = []
+        while True:
+            if not self.typed:
+                await self.drain()
+                data = await self.reader.read(1024)
+                if not data:
+                    raise EOFError
+                self.typed = self.decoder.decode(data)
+                continue
+            char, self.typed = self.typed[0], self.typed[1:]
+            last, self.last = self.last, char
+            if char == "\n" and last == "\r":
+                continue
+            if char in "\r\n":
+                self.write("\n")
+                return "".join(line)
+            if char in "\x7f\b":
+                if line:
+                    line.pop()
+                    self.write(ERASE)
+            elif char == "\x03" or (char == "\x04" and not line):
+                raise EOFError
+            elif char == "\x1b":
+                # Escape sequences, such as arrow keys, are ignored.
+                self.typed = self.typed.lstrip("[0123456789;")[1:]
+            elif char.isprintable():
+                line.append(char)
+                self.write(char)
+
+
+def terminal_console(terminal, **kwargs):
+    """
+    Returns a Rich Console that writes to a session's terminal
+    """
+    return Console(
+        file=terminal,
+        force_terminal=True,
+        color_system="256",
+        width=TERMINAL_WIDTH,
+        height=TERMINAL_HEIGHT,
+        **kwargs,
+    )
+
+
+async def carry_out(request, console, terminal, executor):
+    """
+    Carries out a request from a session flow without blocking the
+    event loop and returns the result to resume the session with
+    """
+    loop = asyncio.get_running_loop()
+    if isinstance(request, Ask):
+        console.print(request.prompt, end="")
+        return await terminal.readline()
+    if isinstance(request, Wait):
+        spinner = Spinner("aesthetic", text=request.status, speed=1.0)
+        with Live(
+            spinner, console=console, auto_refresh=False, transient=True
+        ) as live:
+            give_up_at = loop.time() + request.seconds
+            while loop.time() < give_up_at:
+                live.refresh()
+                await terminal.drain()
+                await asyncio.sleep(SPINNER_INTERVAL)
+        return None
+    if isinstance(request, Block):
+        return await loop.run_in_executor(
+            executor, for_this_session(request.function)
+        )
+    raise TypeError(f"Unknown session request: {request!r}")
+
+
+async def run_connection(
+    reader, writer, doc_pool, executor, write_executor
+):
+    """
+    Runs one session on a connection. If the user disconnects part way
+    through, whatever they have entered so far is still written out.
+    If METRICS_DIR is set, a summary of the Google API calls made for
+    the session is written there when it ends.
+    """
+    loop = asyncio.get_running_loop()
+    terminal = Terminal(reader, writer)
+    console = terminal_console(terminal)
+    error_console = terminal_console(terminal, style="bold red")
+    metrics = ApiMetrics() if METRICS_DIR else None
+    # Each connection runs in its own task, so this is only seen by
+    # this session's work.
+    SESSION_METRICS.set(metrics)
+    sink = None
+    flow = None
+    finished = False
+    try:
+        sink = await loop.run_in_executor(
+            executor,
+            for_this_session(open_sink),
+            doc_pool,
+            executor,
+            write_executor,
+        )
+        session = BudgetSession(sink, console, error_console)
+        flow = session.run()
+        reply = None
+        while True:
+            try:
+                request = flow.send(reply)
+            except StopIteration:
+                finished = True
+                break
+            reply = await carry_out(request, console, terminal, executor)
+        await terminal.drain()
+    except (EOFError, ConnectionError):
+        pass
+    finally:
+        try:
+            if flow is not None:
+                flow.close()
+            if sink is not None and not finished:
+                await loop.run_in_executor(
+                    executor, for_this_session(sink.close)
+                )
+            if metrics is not None and sink is not None:
+                await loop.run_in_executor(executor, lambda: (
+                    metrics.write_summary(
+                        sink.user_uuid, sink=SINK, finished=finished
+                    )
+                ))
+        finally:
+            writer.close()
+
+
+async def retry_periodically():
+    """
+    Replays failed writes and uploads kept summaries in the background
+    every RETRY_INTERVAL seconds, as the server outlives any outage
+    """
+    from sinks import sync_in_background
+    while True:
+        DEAD_LETTERS.replay_in_background(docs_service)
+        sync_in_background(pending_export)
+        await asyncio.sleep(RETRY_INTERVAL)
+
+
+async def serve(host=SESSION_HOST, port=SESSION_PORT):
+    """
+    Serves sessions until cancelled
+    """
+    if METRICS_DIR:
+        API_METRICS.dump_periodically()
+    if SINK.startswith("google"):
+        retrying = asyncio.create_task(retry_periodically())
+    doc_pool = make_doc_pool()
+    executor = ThreadPoolExecutor(
+        max_workers=SESSION_THREADS, thread_name_prefix="session"
+    )
+    write_executor = ThreadPoolExecutor(
+        max_workers=WRITE_THREADS, thread_name_prefix="doc-writer"
+    )
+    server = await asyncio.start_server(
+        lambda reader, writer: run_connection(
+            reader, writer, doc_pool, executor, write_executor
+        ),
+        host,
+        port,
+    )
+    print(f"Travel Budget Planner sessions on {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if SINK.startswith("google"):
+            retrying.cancel()
+        doc_pool.stop()
+        executor.shutdown(wait=False)
+        write_executor.shutdown(wait=False)
+        if METRICS_DIR:
+            API_METRICS.retire()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--host", default=SESSION_HOST)
+    parser.add_argument("--port", type=int, default=SESSION_PORT)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Runs each Travel Budget Planner session in its own process without
+paying Python startup for it. The zygote imports the app and builds
+the Google API clients once, then forks a child per connection that
+goes straight into run.main() on a fresh pseudo-terminal. Children
+share the zygote's imported modules and clients copy-on-write. The
+zygote relays bytes between each connection and its child's terminal,
+so the web front end proxies to it just as it does to session_server.py.
+
+Start it with e.g.
+    python3 session_zygote.py --port 8700
+"""
+import argparse
+import fcntl
+import importlib
+import os
+import pty
+import random
+import selectors
+import signal
+import socket
+import struct
+import sys
+import termios
+import time
+import traceback
+import run
+from metrics import API_METRICS
+from google_services import docs_service, drive_service
+from session_server import (
+    SESSION_HOST, SESSION_PORT, TERMINAL_WIDTH, TERMINAL_HEIGHT
+)
+
+
+DEFERRED_MODULES = [
+    "rich.table",
+    "sinks",
+    "doc_writer",
+    "doc_export",
+    "doc_template",
+    "google_api",
+]
+"""
+Modules that run.py and session.py only import on first use, which
+the zygote imports up front so that no child has to
+"""
+
+TERMINAL_NAME = "xterm-color"
+SEND_TIMEOUT = 5.0
+"""
+Seconds a connection may block the zygote while output is sent to it
+before the session is ended
+"""
+
+
+def warm_up():
+    """
+    Imports the deferred modules, loads the credentials and builds the
+    Google API clients so that every child starts with them ready.
+    No request is made, so the zygote holds no connections or threads
+    for its children to inherit. If the credentials are not available
+    yet, each child loads them itself.
+    """
+    for name in DEFERRED_MODULES:
+        importlib.import_module(name)
+    try:
+        docs_service()
+        drive_service()
+    except (OSError, ValueError) as error:
+        print(f"Google clients will be built per session: {error}")
+
+
+class ForkedSession:
+    def __init__(self, connection, pid, terminal):
+        """
+        A session running in a child process, with the connection to
+        its user and the controlling side of the child's terminal
+        """
+        self.connection = connection
+        self.pid = pid
+        self.terminal = terminal
+        self.closed = False
+
+    def close(self):
+        """ Hangs up the child's terminal and closes the connection. """
+        self.closed = True
+        try:
+            os.kill(self.pid, signal.SIGHUP)
+        except ProcessLookupError:
+            pass
+        os.close(self.terminal)
+        self.connection.close()
+
+
+def hang_up(signum, frame):
+    """
+    Ends a child's session when its connection closes, as the end of
+    its input would, so that what the user entered is still written
+    out rather than lost with the process. Only the first hang-up does
+    so, and not if the session is already ending, such as when reading
+    the terminal has just reached its end, so that writing the summary
+    out is never interrupted.
+    """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if sys.exc_info()[1] is None:
+        raise EOFError
+
+
+def run_child(listener, selector, sessions):
+    """
+    Runs one session in a newly forked child, whose standard streams
+    are its terminal, and exits the child when it ends
+    """
+    status = 0
+    try:
+        selector.close()
+        listener.close()
+        for session in sessions:
+            session.connection.close()
+            os.close(session.terminal)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, hang_up)
+        fcntl.ioctl(
+            sys.stdin.fileno(),
+            termios.TIOCSWINSZ,
+            struct.pack("HHHH", TERMINAL_HEIGHT, TERMINAL_WIDTH, 0, 0),
+        )
+        os.environ["TERM"] = TERMINAL_NAME
+        # Children would otherwise share the zygote's random state and
+        # back off from errors in lockstep.
+        random.seed()
+        API_METRICS.started = time.time()
+        run.main()
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except OSError:
+            # The terminal has been hung up.
+            pass
+        os._exit(status)
+
+
+def start_session(listener, selector, sessions):
+    """
+    Accepts a connection and forks a child to run its session
+    """
+    connection, _ = listener.accept()
+    # Anything still buffered would otherwise be written out again by
+    # the child, to its terminal.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid, terminal = pty.fork()
+    if pid == 0:
+        connection.close()
+        run_child(listener, selector, sessions)
+    connection.settimeout(SEND_TIMEOUT)
+    session = ForkedSession(connection, pid, terminal)
+    sessions.add(session)
+    selector.register(connection, selectors.EVENT_READ, session)
+    selector.register(terminal, selectors.EVENT_READ, session)
+
+
+def end_session(selector, sessions, session):
+    """ Stops relaying a session and closes it. """
+    selector.unregister(session.connection)
+    selector.unregister(session.terminal)
+    sessions.discard(session)
+    session.close()
+
+
+def relay(selector, sessions, session, source):
+    """
+    Passes bytes from a connection to its child's terminal or back,
+    ending the session when either side closes
+    """
+    if session.closed:
+        # Both sides were ready, and the first ended the session.
+        return
+    try:
+        if source is session.connection:
+            data = session.connection.recv(4096)
+            if data:
+                os.write(session.terminal, data)
+        else:
+            data = os.read(session.terminal, 4096)
+            if data:
+                session.connection.sendall(data)
+    except OSError:
+        # Reading a terminal whose child has exited raises EIO.
+        data = b""
+    if not data:
+        end_session(selector, sessions, session)
+
+
+def serve(host=SESSION_HOST, port=SESSION_PORT):
+    """
+    Accepts connections and relays sessions until interrupted
+    """
+    warm_up()
+    # Exited children are reaped automatically.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    listener = socket.create_server((host, port))
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ, None)
+    sessions = set()
+    print(f"Travel Budget Planner session zygote on {host}:{port}")
+    while True:
+        for key, _ in selector.select():
+            if key.data is None:
+                start_session(listener, selector, sessions)
+            else:
+                relay(selector, sessions, key.data, key.fileobj)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--host", default=SESSION_HOST)
+    parser.add_argument("--port", type=int, default=SESSION_PORT)
+    args = parser.parse_args()
+    try:
+        serve(args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
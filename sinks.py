@@ -0,0 +1,303 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from file_lock import file_lock
+
+
+SUMMARY_DIR = "summaries"
+SUMMARY_DB = "summaries.db"
+
+PENDING_DB = "pending_uploads.db"
+"""
+SQLite database of the summaries of sessions that could not reach
+Google, kept until they can be uploaded
+"""
+
+
+class Sink:
+    """
+    Somewhere the session's summary is written to. The session only
+    uses the methods below, so any sink can be swapped in. Each
+    piece of output is tagged with the section of the summary it
+    belongs to, which sinks that lay the summary out by section use.
+    """
+    user_uuid = None
+
+    def __init__(self):
+        self.replaced_sections = {}
+
+    def append(self, text, section=None):
+        """ Adds a line of text to the summary. """
+        raise NotImplementedError
+
+    def append_table(self, rows, section=None):
+        """ Adds a table, given as a list of rows of cell text. """
+        raise NotImplementedError
+
+    def replace_section(self, section, parts):
+        """
+        Replaces what was last written to the section with a list of
+        ("text", text) and ("table", rows) parts, so the section can be
+        rewritten as the session goes without repeating it. Sinks that
+        can only append keep the latest parts of each section and write
+        them out with write_sections when they are closed.
+        """
+        self.replaced_sections[section] = parts
+
+    def write_sections(self):
+        """
+        Appends the latest parts of each replaced section, in the order
+        the sections were first written
+        """
+        for section, parts in self.replaced_sections.items():
+            for kind, content in parts:
+                if kind == "table":
+                    self.append_table(content, section=section)
+                else:
+                    self.append(content.removesuffix("\n"), section=section)
+        self.replaced_sections = {}
+
+    def flush(self):
+        """ Starts sending any buffered output on, without waiting. """
+
+    def drain(self):
+        """ Waits until all output so far has been written. """
+
+    def close(self):
+        """ Writes any remaining output at the end of the session. """
+
+    @property
+    def link(self):
+        """ Returns where the user can find their summary. """
+        raise NotImplementedError
+
+
+class MarkdownFileSink(Sink):
+    def __init__(self, directory=SUMMARY_DIR):
+        """
+        Writes the summary to a local Markdown file named after the
+        session's UUID
+        """
+        super().__init__()
+        self.user_uuid = str(uuid.uuid4())
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.abspath(
+            os.path.join(directory, f"{self.user_uuid}.md")
+        )
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.file.write(f"# Travel Budget Planner - {self.user_uuid}\n")
+
+    def append(self, text, section=None):
+        self.file.write(f"{text}\n")
+
+    def append_table(self, rows, section=None):
+        header, *body = rows
+        lines = [
+            "| " + " | ".join(header) + " |",
+            "|" + "---|" * len(header),
+        ]
+        lines.extend("| " + " | ".join(row) + " |" for row in body)
+        self.file.write("\n" + "\n".join(lines) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def drain(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.write_sections()
+            self.file.close()
+
+    @property
+    def link(self):
+        return self.path
+
+
+def connect(path=SUMMARY_DB):
+    """
+    Opens the summary database, creating its tables if needed. WAL mode
+    lets many session processes write to it at once. A session writes
+    from whichever worker thread runs its blocking calls, one call at a
+    time, so the connection is not tied to the thread that opened it.
+    """
+    connection = sqlite3.connect(
+        path, timeout=10, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        "user_uuid TEXT PRIMARY KEY, "
+        "created REAL NOT NULL, "
+        "document_id TEXT, "
+        "closed REAL)"
+    )
+    columns = [
+        row[1] for row in connection.execute("PRAGMA table_info(sessions)")
+    ]
+    if "closed" not in columns:
+        # Databases made before sessions were marked closed
+        connection.execute("ALTER TABLE sessions ADD COLUMN closed REAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS summary_parts ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "user_uuid TEXT NOT NULL REFERENCES sessions(user_uuid), "
+        "kind TEXT NOT NULL, "
+        "content TEXT NOT NULL)"
+    )
+    connection.commit()
+    return connection
+
+
+class SQLiteSink(Sink):
+    def __init__(self, path=SUMMARY_DB):
+        """
+        Writes the summary as rows of a local SQLite table, one per
+        line of text or table, so sessions can be synced to Google later
+        by running python3 sinks.py
+        """
+        super().__init__()
+        self.user_uuid = str(uuid.uuid4())
+        self.path = os.path.abspath(path)
+        self.connection = connect(path)
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO sessions (user_uuid, created) VALUES (?, ?)",
+                (self.user_uuid, time.time()),
+            )
+
+    def add_part(self, kind, content):
+        """ Stores a part of the summary. """
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO summary_parts (user_uuid, kind, content) "
+                "VALUES (?, ?, ?)",
+                (self.user_uuid, kind, json.dumps(content)),
+            )
+
+    def append(self, text, section=None):
+        self.add_part("text", f"{text}\n")
+
+    def append_table(self, rows, section=None):
+        self.add_part("table", rows)
+
+    def close(self):
+        """
+        Writes the sections out and marks the session closed, so that
+        it is only synced once its summary is complete
+        """
+        self.write_sections()
+        with self.connection:
+            self.connection.execute(
+                "UPDATE sessions SET closed = ? WHERE user_uuid = ?",
+                (time.time(), self.user_uuid),
+            )
+        self.connection.close()
+
+    @property
+    def link(self):
+        return f"{self.path} (session {self.user_uuid})"
+
+
+class PendingUploadSink(SQLiteSink):
+    def __init__(self, path=PENDING_DB):
+        """
+        Keeps the summary of a session that could not reach Google, so
+        that sync_in_background uploads it to its own Google Doc once
+        Google can be reached again
+        """
+        super().__init__(path)
+
+    @property
+    def link(self):
+        # There is no document to link to until the summary is uploaded.
+        return None
+
+
+def sync_to_google(make_export, path=SUMMARY_DB):
+    """
+    Uploads every closed session in the summary database that has not
+    been synced yet to its own Google Doc. Sessions still running are
+    left for a later sync. make_export(user_uuid) must return a
+    DocumentExport for the session that raises if its upload fails,
+    which stops the sync and leaves the rest of the sessions for next
+    time. Returns the user UUID and link of every session uploaded.
+    Only one process syncs a database at a time.
+    """
+    synced = []
+    with file_lock(path + ".sync.lock", blocking=False) as got:
+        if not got:
+            return synced
+        connection = connect(path)
+        try:
+            sessions = connection.execute(
+                "SELECT user_uuid FROM sessions "
+                "WHERE document_id IS NULL AND closed IS NOT NULL "
+                "ORDER BY created"
+            ).fetchall()
+            for (user_uuid,) in sessions:
+                export = make_export(user_uuid)
+                parts = connection.execute(
+                    "SELECT kind, content FROM summary_parts "
+                    "WHERE user_uuid = ? ORDER BY id",
+                    (user_uuid,),
+                )
+                for kind, content in parts:
+                    if kind == "table":
+                        export.append_table(json.loads(content))
+                    else:
+                        export.append(json.loads(content).removesuffix("\n"))
+                export.close()
+                with connection:
+                    connection.execute(
+                        "UPDATE sessions SET document_id = ? "
+                        "WHERE user_uuid = ?",
+                        (export.document_id, user_uuid),
+                    )
+                synced.append((user_uuid, export.link))
+        finally:
+            connection.close()
+    return synced
+
+
+def sync_in_background(make_export, path=PENDING_DB):
+    """
+    Syncs the database to Google from a background thread. Failures
+    leave the sessions for a later sync rather than being printed over
+    the session.
+    """
+    def sync():
+        from google_api import TRANSPORT_ERRORS
+        try:
+            sync_to_google(make_export, path)
+        except (*TRANSPORT_ERRORS, ValueError):
+            # Google is still unreachable, or there are no credentials.
+            pass
+
+    thread = threading.Thread(target=sync, name="summary-sync", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    """
+    Uploads the sessions written by the SQLite sink, and any kept while
+    Google could not be reached, that have not been synced yet and
+    prints the link to each one's document
+    """
+    from google_api import TRANSPORT_ERRORS
+    from run import pending_export
+    for path in [SUMMARY_DB, PENDING_DB]:
+        try:
+            for user_uuid, link in sync_to_google(pending_export, path):
+                print(f"{user_uuid}: {link}")
+        except TRANSPORT_ERRORS as error:
+            print(f"An error occurred: {error}")
+
+
+if __name__ == "__main__":
+    main()
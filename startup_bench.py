@@ -0,0 +1,225 @@
+"""
+Measures how long the Travel Budget Planner takes from starting
+python3 run.py to showing its first prompt, and which imports cost the
+most on the way there, as reported by python -X importtime. Each result
+is added to a history file and compared with the best result before it,
+so that startup regressions are caught.
+
+Run it with e.g.
+    python3 startup_bench.py --runs 5
+or, to measure the zipapp bundle built by build_bundle.py,
+    python3 startup_bench.py --bundle dist/travel_budget.pyz
+Add --cold to drop the page cache before each run, as on a host whose
+file cache is cold, which needs root on Linux. It exits with status 1
+if startup has regressed.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FIRST_PROMPT = "> £".encode("utf-8")
+"""
+Output that shows the first question is waiting for an answer
+"""
+
+HISTORY_FILE = "startup_history.jsonl"
+TOLERANCE = 0.2
+"""
+Fraction by which startup may be slower than the best result in the
+history before it counts as a regression
+"""
+
+TOP_IMPORTS = 15
+
+DROP_CACHES = "/proc/sys/vm/drop_caches"
+
+
+def parse_importtime(output):
+    """
+    Returns the name, depth, self time and cumulative time in
+    microseconds of every import in python -X importtime output, in the
+    order they finished
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        if not self_time.strip().isdigit():
+            # The header line
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append(
+            (name.strip(), depth, int(self_time), int(cumulative))
+        )
+    return imports
+
+
+def drop_caches():
+    """
+    Writes dirty pages out and drops the page cache, so that the next
+    run reads its files from disk
+    """
+    os.sync()
+    with open(DROP_CACHES, "w", encoding="utf-8") as f:
+        f.write("3\n")
+
+
+def measure(command, env):
+    """
+    Starts a session once with the command and returns the seconds
+    until its first prompt and the imports it made before then
+    """
+    with tempfile.TemporaryFile() as errors:
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-X", "importtime", *command],
+            cwd=APP_DIR,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=errors,
+        )
+        output = b""
+        while FIRST_PROMPT not in output:
+            chunk = process.stdout.read1(4096)
+            if not chunk:
+                process.wait()
+                raise RuntimeError(
+                    f"The session exited with {process.returncode} before "
+                    "its first prompt"
+                )
+            output += chunk
+        elapsed = time.perf_counter() - started
+        process.kill()
+        process.wait()
+        process.stdout.close()
+        process.stdin.close()
+        errors.seek(0)
+        imports = parse_importtime(errors.read().decode("utf-8", "replace"))
+    return elapsed, imports
+
+
+def slowest_imports(imports):
+    """
+    Returns the top-level imports by cumulative time in milliseconds,
+    slowest first
+    """
+    top_level = [
+        (name, cumulative / 1000)
+        for name, depth, _, cumulative in imports
+        if depth == 0
+    ]
+    return sorted(top_level, key=lambda item: item[1], reverse=True)
+
+
+def load_history(path):
+    """ Returns the results recorded so far. """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def record(path, result):
+    """ Adds a result to the history file. """
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument(
+        "--tolerance", type=float, default=TOLERANCE,
+        help="allowed slowdown against the best recorded median",
+    )
+    parser.add_argument(
+        "--bundle",
+        help="measure a zipapp bundle, started with -S, instead of run.py",
+    )
+    parser.add_argument(
+        "--cold", action="store_true",
+        help="drop the page cache before each run",
+    )
+    parser.add_argument(
+        "--no-record", action="store_true",
+        help="compare with the history without adding to it",
+    )
+    args = parser.parse_args()
+    env = {**os.environ, "PYTHONIOENCODING": "utf-8"}
+    command = ["-S", args.bundle] if args.bundle else ["run.py"]
+    cache = "cold" if args.cold else "warm"
+
+    timings = []
+    import_costs = {}
+    for _ in range(args.runs):
+        if args.cold:
+            drop_caches()
+        elapsed, imports = measure(command, env)
+        timings.append(elapsed)
+        for name, milliseconds in slowest_imports(imports):
+            import_costs.setdefault(name, []).append(milliseconds)
+    median = statistics.median(timings)
+    imports = sorted(
+        (
+            (name, statistics.median(costs))
+            for name, costs in import_costs.items()
+        ),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+
+    print(
+        f"Time to first prompt: median {median:.3f}s "
+        f"(min {min(timings):.3f}s, max {max(timings):.3f}s) "
+        f"over {args.runs} runs with a {cache} file cache"
+    )
+    print("\nSlowest top-level imports before the first prompt:")
+    for name, milliseconds in imports[:TOP_IMPORTS]:
+        print(f"  {milliseconds:8.1f} ms  {name}")
+    total = sum(milliseconds for _, milliseconds in imports)
+    print(f"  {total:8.1f} ms  in total")
+
+    history = [
+        result for result in load_history(args.history)
+        if result.get("command", ["run.py"]) == command
+        and result.get("cache", "warm") == cache
+    ]
+    regressed = False
+    if history:
+        best = min(result["median"] for result in history)
+        change = median / best - 1
+        print(f"\n{change:+.1%} against the best recorded {best:.3f}s")
+        regressed = change > args.tolerance
+        if regressed:
+            print(f"Startup has regressed by more than {args.tolerance:.0%}")
+    if not args.no_record:
+        record(args.history, {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "command": command,
+            "cache": cache,
+            "runs": [round(timing, 6) for timing in timings],
+            "median": round(median, 6),
+            "imports": {
+                name: round(milliseconds, 3)
+                for name, milliseconds in imports[:TOP_IMPORTS]
+            },
+        })
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
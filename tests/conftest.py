@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import Future
+import pytest
+import fake_google
+import google_services
+from doc_writer import DocumentWriter
+
+
+@pytest.fixture(scope="session")
+def fake_server():
+    """
+    Runs the fake Google APIs on a free local port for the whole test
+    session
+    """
+    server = fake_google.serve(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="session")
+def docs(fake_server):
+    """ Returns a Docs client that talks to the fake server. """
+    endpoint = f"http://127.0.0.1:{fake_server.server_address[1]}"
+    with pytest.MonkeyPatch.context() as patch:
+        # Credentials are only skipped when an endpoint is configured.
+        patch.setattr(google_services, "API_ENDPOINT", endpoint)
+        yield google_services.build_from_endpoint("docs", "v1", endpoint)
+
+
+@pytest.fixture(autouse=True)
+def local_files(tmp_path, monkeypatch):
+    """
+    Keeps the shared rate limits and any Markdown fallback written by a
+    test in its own directory
+    """
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def new_document(docs, fake_server):
+    """
+    Returns a function that creates an empty document on the fake
+    server and returns the fake's copy of it, to check what was
+    written to it
+    """
+    def new_document():
+        document_id = docs.documents().create(
+            body={"title": "Travel Budget Summary"}
+        ).execute()["documentId"]
+        return fake_server.RequestHandlerClass.fake.documents[document_id]
+
+    return new_document
+
+
+@pytest.fixture
+def make_writer(docs, new_document):
+    """
+    Returns a function that creates an empty document and a
+    DocumentWriter for it, along with the fake's copy of the document
+    """
+    writers = []
+
+    def make_writer():
+        fake_document = new_document()
+        document = Future()
+        document.set_result(("test-session", fake_document.document_id))
+        writer = DocumentWriter(docs, document)
+        writers.append(writer)
+        return writer, fake_document
+
+    yield make_writer
+    for writer in writers:
+        writer.close()
@@ -0,0 +1,85 @@
+from concurrent.futures import TimeoutError
+import pytest
+from googleapiclient.errors import HttpError
+from batch_dispatcher import BatchDispatcher
+from fake_google import from_units
+from google_api import dispatched
+
+
+@pytest.fixture
+def http_batches(docs, monkeypatch):
+    """
+    Records the number of requests in each HTTP batch the Docs client
+    sends
+    """
+    sizes = []
+    new_batch = docs.new_batch_http_request
+
+    def recording_new_batch(**kwargs):
+        http_batch = new_batch(**kwargs)
+        sizes.append(0)
+        add = http_batch.add
+
+        def recording_add(*args, **kwargs):
+            sizes[-1] += 1
+            return add(*args, **kwargs)
+
+        http_batch.add = recording_add
+        return http_batch
+
+    monkeypatch.setattr(docs, "new_batch_http_request", recording_new_batch)
+    return sizes
+
+
+def insert_text(docs, document_id, text):
+    """ Returns a batchUpdate request that inserts text at the start. """
+    return docs.documents().batchUpdate(
+        documentId=document_id,
+        body={
+            "requests": [
+                {"insertText": {"location": {"index": 1}, "text": text}}
+            ]
+        },
+    )
+
+
+def test_requests_are_sent_in_one_batch(docs, new_document, http_batches):
+    dispatcher = BatchDispatcher(docs, window=0.2)
+    documents = [new_document() for _ in range(3)]
+    futures = [
+        dispatcher.submit(insert_text(docs, document.document_id, text))
+        for document, text in zip(documents, ["One\n", "Two\n", "Three\n"])
+    ]
+    missing = dispatcher.submit(insert_text(docs, "missing", "Lost\n"))
+
+    responses = [future.result(timeout=5) for future in futures]
+
+    assert http_batches == [4]
+    assert [response["documentId"] for response in responses] == [
+        document.document_id for document in documents
+    ]
+    assert [from_units(document.units) for document in documents] == [
+        "One\n\n", "Two\n\n", "Three\n\n",
+    ]
+    # Only the failed request's caller gets its error.
+    with pytest.raises(HttpError) as error:
+        missing.result(timeout=5)
+    assert error.value.resp.status == 404
+
+
+def test_cancelled_request_is_not_sent(docs, new_document, http_batches):
+    dispatcher = BatchDispatcher(docs, window=0.2)
+    cancelled, sent = new_document(), new_document()
+    request = insert_text(docs, cancelled.document_id, "Cancelled\n")
+    # The caller gives up before the window closes.
+    with pytest.raises(TimeoutError):
+        dispatched(dispatcher, request, timeout=0)
+    dispatcher.submit(
+        insert_text(docs, sent.document_id, "Sent\n")
+    ).result(timeout=5)
+
+    assert from_units(sent.units) == "Sent\n\n"
+    assert from_units(cancelled.units) == "\n"
+    # The batch held only the request still wanted, so it was sent on
+    # its own rather than through the batch endpoint.
+    assert http_batches == []
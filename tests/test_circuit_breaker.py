@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+import pytest
+import circuit_breaker
+from circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Replaces the breaker's clock with one that only moves when a test
+    advances it
+    """
+    now = [1000.0]
+
+    def advance(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(
+        circuit_breaker, "time", SimpleNamespace(monotonic=lambda: now[0])
+    )
+    return advance
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(
+        failure_threshold=3, latency_threshold=5.0, reset_timeout=30.0
+    )
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    # A success in between resets the count.
+    breaker.record_success(0.1)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+
+
+def test_slow_calls_count_as_failures(breaker):
+    for _ in range(3):
+        breaker.record_success(5.5)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_one_probe_is_let_through_after_the_reset_timeout(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock(29.0)
+    assert not breaker.allow_request()
+
+    clock(1.0)
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only the probe is let through until it reports back.
+    assert not breaker.allow_request()
+
+
+def test_closes_when_the_probe_succeeds(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock(30.0)
+    assert breaker.allow_request()
+
+    breaker.record_success(0.2)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+    # The count of failures starts again.
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_reopens_when_the_probe_fails(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock(30.0)
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    clock(30.0)
+    assert breaker.allow_request()
+
+
+def test_a_lost_probe_is_replaced(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure()
+    clock(30.0)
+    assert breaker.allow_request()
+    # The probe never reports back.
+    clock(30.0)
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
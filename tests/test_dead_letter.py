@@ -0,0 +1,127 @@
+import json
+import httplib2
+from googleapiclient.errors import HttpError
+import doc_writer
+from dead_letter import DeadLetterQueue, REJECTED_SUFFIX
+from fake_google import from_units
+from file_lock import file_lock
+
+
+def rejected(queue):
+    """ Returns the entries the queue has set aside. """
+    with open(queue.path + REJECTED_SUFFIX, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def queued_text(queue):
+    """ Returns the text of each queued entry in order. """
+    return [content for entry in queue.load() for _, content in entry["parts"]]
+
+
+def test_replay_writes_in_order_and_removes_what_it_wrote(
+    docs, new_document
+):
+    first, second = new_document(), new_document()
+    queue = DeadLetterQueue()
+    queue.add(first.document_id, "session-1", [("text", "One\n")])
+    queue.add(second.document_id, "session-2", [("text", "Alpha\n")])
+    queue.add(first.document_id, "session-1", [("text", "Two\n")])
+    queue.add(second.document_id, "session-2", [("text", "Beta\n")])
+    queue.add(first.document_id, "session-1", [("text", "Three\n")])
+
+    assert queue.replay(docs, first.document_id)
+
+    assert from_units(first.units) == "One\nTwo\nThree\n\n"
+    assert from_units(second.units) == "\n"
+    assert queued_text(queue) == ["Alpha\n", "Beta\n"]
+
+    assert queue.replay(docs)
+
+    assert from_units(second.units) == "Alpha\nBeta\n\n"
+    assert queue.load() == []
+    # Nothing is written twice.
+    assert queue.replay(docs)
+    assert from_units(first.units) == "One\nTwo\nThree\n\n"
+
+
+def test_entries_stay_queued_while_google_is_unavailable(
+    docs, new_document, monkeypatch
+):
+    document = new_document()
+    queue = DeadLetterQueue()
+    queue.add(document.document_id, "session", [("text", "Taxi\n")])
+    queue.add(document.document_id, "session", [("text", "Boat\n")])
+
+    def unavailable(service, document_id, parts):
+        raise HttpError(httplib2.Response({"status": 503}), b"")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(doc_writer, "append_parts", unavailable)
+        assert not queue.replay(docs)
+    assert queued_text(queue) == ["Taxi\n", "Boat\n"]
+
+    # Another process is already replaying the queue.
+    with file_lock(queue.path + ".replay.lock"):
+        assert not queue.replay(docs)
+    assert from_units(document.units) == "\n"
+
+    assert queue.replay(docs)
+    assert from_units(document.units) == "Taxi\nBoat\n\n"
+    assert queue.load() == []
+
+
+def test_a_line_cut_short_is_skipped():
+    queue = DeadLetterQueue()
+    queue.add("document", "session", [("text", "Taxi\n")])
+    with open(queue.path, "a", encoding="utf-8") as f:
+        f.write('{"id": "cut-sh')
+
+    assert queued_text(queue) == ["Taxi\n"]
+
+
+def test_rejected_entries_are_set_aside(docs, new_document):
+    document = new_document()
+    queue = DeadLetterQueue()
+    queue.add("deleted-document", "session-1", [("text", "Lost\n")])
+    queue.add(document.document_id, "session-2", [("text", "Taxi\n")])
+    # An empty search text is rejected by the API with a 400.
+    queue.add(document.document_id, "session-2", [("replace", {"": "x"})])
+    queue.add(document.document_id, "session-2", [("text", "Boat\n")])
+
+    assert queue.replay(docs)
+
+    assert queue.load() == []
+    assert from_units(document.units) == "Taxi\nBoat\n\n"
+    set_aside = rejected(queue)
+    assert [entry["document_id"] for entry in set_aside] == [
+        "deleted-document", document.document_id,
+    ]
+    assert "404" in set_aside[0]["error"]
+    assert "400" in set_aside[1]["error"]
+    # Nothing is sent again on the next replay.
+    assert queue.replay(docs)
+    assert len(rejected(queue)) == 2
+
+
+def test_spooled_section_replaces_the_one_in_the_document(
+    docs, make_writer
+):
+    writer, document = make_writer()
+    writer.replace_section("expenses", [("text", "Taxi\n")])
+    writer.append("Thank you")
+    writer.drain()
+    queue = DeadLetterQueue()
+    for expenses in ["Taxi\nBoat\n", "Taxi\nBoat\nTrain\n"]:
+        queue.add(
+            document.document_id,
+            "session",
+            [("section", {"name": "expenses", "parts": [("text", expenses)]})],
+        )
+
+    assert queue.replay(docs)
+
+    assert from_units(document.units) == "Taxi\nBoat\nTrain\nThank you\n\n"
+    assert [
+        (name, start, end) for name, start, end
+        in document.named_ranges.values()
+    ] == [("expenses", 1, 17)]
@@ -0,0 +1,272 @@
+import json
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+import pytest
+import doc_writer
+from doc_writer import DocumentWriter
+from fake_google import STRUCTURE, from_units
+
+
+CELL = re.compile(f"{STRUCTURE}([^{STRUCTURE}\n]*)\n")
+"""
+Matches the text of a table cell in a fake document's units, which
+follows the cell's own structure index and ends with its newline
+"""
+
+
+@pytest.fixture
+def batch_updates(monkeypatch):
+    """
+    Records the requests of every batchUpdate the writer sends,
+    including ones the document rejects
+    """
+    sent = []
+    execute = doc_writer.execute
+
+    def recording_execute(request, *args, **kwargs):
+        if request.methodId == "docs.documents.batchUpdate":
+            sent.append(json.loads(request.body)["requests"])
+        return execute(request, *args, **kwargs)
+
+    monkeypatch.setattr(doc_writer, "execute", recording_execute)
+    return sent
+
+
+def text_of(document):
+    """ Returns the document's text without its table structure. """
+    return from_units(document.units.replace(STRUCTURE, ""))
+
+
+def range_units(document, name):
+    """
+    Returns the UTF-16 code units covered by the only named range
+    called name
+    """
+    spans = [
+        (start, end)
+        for range_name, start, end in document.named_ranges.values()
+        if range_name == name
+    ]
+    assert len(spans) == 1
+    start, end = spans[0]
+    return document.units[start - 1:end - 1]
+
+
+def range_text(document, name):
+    """
+    Returns the text of a named range without its table structure
+    """
+    return from_units(range_units(document, name).replace(STRUCTURE, ""))
+
+
+def table_cells(document, name):
+    """ Returns the text of each table cell in a named range in order. """
+    return [
+        from_units(cell) for cell in CELL.findall(range_units(document, name))
+    ]
+
+
+def inserted_text(requests):
+    """ Returns the text of every insertText request. """
+    return [
+        request["insertText"]["text"]
+        for request in requests
+        if "insertText" in request
+    ]
+
+
+def request_kinds(requests):
+    """ Returns the kind of every request. """
+    return {kind for request in requests for kind in request}
+
+
+def test_sections_are_edited_in_place(make_writer, batch_updates):
+    writer, document = make_writer()
+    writer.append("Your travel budget is £1,000.00")
+    writer.replace_section("expenses", [("text", "Taxi: £5.00\n")])
+    writer.replace_section("final_summary", [("text", "Total: £5.00\n")])
+    writer.drain()
+    writer.replace_section(
+        "expenses", [("text", "Taxi: £5.00\nBoat trip: £10.00\n")]
+    )
+    writer.replace_section("final_summary", [("text", "Total: £15.00\n")])
+    writer.drain()
+
+    assert text_of(document) == (
+        "Your travel budget is £1,000.00\n"
+        "Taxi: £5.00\nBoat trip: £10.00\n"
+        "Total: £15.00\n"
+        "\n"
+    )
+    assert range_text(document, "expenses") == (
+        "Taxi: £5.00\nBoat trip: £10.00\n"
+    )
+    assert range_text(document, "final_summary") == "Total: £15.00\n"
+    # Only the new text is inserted, and nothing is deleted.
+    assert inserted_text(batch_updates[-1]) == ["Boat trip: £10.00\n", "1"]
+    assert "deleteContentRange" not in request_kinds(batch_updates[-1])
+
+
+def test_table_shape_changes(make_writer, batch_updates):
+    writer, document = make_writer()
+
+    def write_summary(rows, total):
+        writer.replace_section(
+            "expense_summary",
+            [("text", "\nExpense Summary\n"), ("table", rows)],
+        )
+        writer.replace_section("final_summary", [("text", f"{total}\n")])
+        writer.drain()
+
+    header = ["Category", "Running Total"]
+    write_summary([header, ["Food", "£5.00"]], "Total: £5.00")
+    # A row is added, so the table is rewritten whole.
+    write_summary(
+        [header, ["Food", "£5.00"], ["Travel", "£20.00"]], "Total: £25.00"
+    )
+    assert "insertTable" in request_kinds(batch_updates[-1])
+    assert table_cells(document, "expense_summary") == [
+        "Category", "Running Total", "Food", "£5.00", "Travel", "£20.00",
+    ]
+    assert range_text(document, "final_summary") == "Total: £25.00\n"
+
+    # The shape is unchanged, so only the cell text is edited.
+    write_summary(
+        [header, ["Food", "£7.50"], ["Travel", "£120.00"]], "Total: £127.50"
+    )
+    assert "insertTable" not in request_kinds(batch_updates[-1])
+    assert table_cells(document, "expense_summary") == [
+        "Category", "Running Total", "Food", "£7.50", "Travel", "£120.00",
+    ]
+    assert range_text(document, "expense_summary") == (
+        "\nExpense Summary\n\n"
+        "Category\nRunning Total\nFood\n£7.50\nTravel\n£120.00\n"
+    )
+    assert range_text(document, "final_summary") == "Total: £127.50\n"
+
+    # A row is removed again.
+    write_summary([header, ["Travel", "£120.00"]], "Total: £120.00")
+    assert table_cells(document, "expense_summary") == [
+        "Category", "Running Total", "Travel", "£120.00",
+    ]
+    assert range_text(document, "final_summary") == "Total: £120.00\n"
+    assert text_of(document) == (
+        "\nExpense Summary\n\n"
+        "Category\nRunning Total\nTravel\n£120.00\n"
+        "Total: £120.00\n"
+        "\n"
+    )
+
+
+def test_emoji_take_two_indexes(make_writer):
+    writer, document = make_writer()
+    writer.append("Trip to the 🏝️ islands")
+    writer.replace_section("expenses", [("text", "Snorkel 🤿: £20.00\n")])
+    writer.replace_section(
+        "expense_summary",
+        [
+            ("text", "Summary 📊\n"),
+            ("table", [["Category", "Total"], ["🍦 Food", "£3.00"]]),
+        ],
+    )
+    writer.replace_section("final_summary", [("text", "Left: £77.00 😀\n")])
+    writer.drain()
+    # 😀 and 😁 share their first UTF-16 code unit.
+    writer.replace_section(
+        "expenses",
+        [("text", "Snorkel 🤿: £20.00\nSurf 🏄‍♀️: £30.00\n")],
+    )
+    writer.replace_section(
+        "expense_summary",
+        [
+            ("text", "Summary 📊\n"),
+            ("table", [["Category", "Total"], ["🍦🍦 Food", "£6.00"]]),
+        ],
+    )
+    writer.replace_section("final_summary", [("text", "Left: £44.00 😁\n")])
+    writer.drain()
+
+    assert range_text(document, "expenses") == (
+        "Snorkel 🤿: £20.00\nSurf 🏄‍♀️: £30.00\n"
+    )
+    assert table_cells(document, "expense_summary") == [
+        "Category", "Total", "🍦🍦 Food", "£6.00",
+    ]
+    assert range_text(document, "final_summary") == "Left: £44.00 😁\n"
+    assert text_of(document) == (
+        "Trip to the 🏝️ islands\n"
+        "Snorkel 🤿: £20.00\nSurf 🏄‍♀️: £30.00\n"
+        "Summary 📊\n\nCategory\nTotal\n🍦🍦 Food\n£6.00\n"
+        "Left: £44.00 😁\n"
+        "\n"
+    )
+
+
+def test_resyncs_when_document_changed_elsewhere(
+    make_writer, docs, batch_updates
+):
+    writer, document = make_writer()
+    writer.replace_section("expenses", [("text", "Taxi: £5.00\n")])
+    writer.replace_section("final_summary", [("text", "Total: £5.00\n")])
+    writer.drain()
+    docs.documents().batchUpdate(
+        documentId=document.document_id,
+        body={
+            "requests": [
+                {
+                    "insertText": {
+                        "location": {"index": 1},
+                        "text": "Shared with the 👪 family\n",
+                    }
+                }
+            ]
+        },
+    ).execute()
+
+    writer.replace_section(
+        "expenses", [("text", "Taxi: £5.00\nBoat trip: £10.00\n")]
+    )
+    writer.replace_section("final_summary", [("text", "Total: £15.00\n")])
+    writer.append("Thank you")
+    writer.drain()
+
+    # The stale write was rejected, then sent again after a resync.
+    assert len(batch_updates) == 3
+    assert "deleteContentRange" in request_kinds(batch_updates[-1])
+    assert range_text(document, "expenses") == (
+        "Taxi: £5.00\nBoat trip: £10.00\n"
+    )
+    assert range_text(document, "final_summary") == "Total: £15.00\n"
+    assert text_of(document) == (
+        "Shared with the 👪 family\n"
+        "Taxi: £5.00\nBoat trip: £10.00\n"
+        "Total: £15.00\n"
+        "Thank you\n"
+        "\n"
+    )
+
+
+def test_writers_share_an_executor(docs, new_document):
+    executor = ThreadPoolExecutor(max_workers=1)
+    ready, waiting = new_document(), new_document()
+    waiting_future = Future()
+    ready_future = Future()
+    ready_future.set_result(("ready-session", ready.document_id))
+    # The second writer's document is still being made, which must not
+    # hold up the first one's writes on the shared thread.
+    late_writer = DocumentWriter(docs, waiting_future, executor=executor)
+    writer = DocumentWriter(docs, ready_future, executor=executor)
+    for line in ("Late 1", "Late 2"):
+        late_writer.append(line)
+        late_writer.flush()
+    for line in ("One", "Two", "Three"):
+        writer.append(line)
+        writer.flush()
+    writer.drain()
+    assert text_of(ready) == "One\nTwo\nThree\n\n"
+
+    waiting_future.set_result(("late-session", waiting.document_id))
+    late_writer.close()
+    writer.close()
+    executor.shutdown()
+    assert text_of(waiting) == "Late 1\nLate 2\n\n"
@@ -0,0 +1,28 @@
+import contextvars
+from metrics import SESSION_METRICS, ApiMetrics
+
+
+def batch_update_calls(metrics):
+    """ Returns how many batchUpdate calls the metrics recorded. """
+    operations = metrics.summary()["operations"]
+    return operations["docs.documents.batchUpdate"]["calls"]
+
+
+def test_sessions_only_record_their_own_calls(make_writer):
+    def run_session(edits):
+        metrics = ApiMetrics()
+        SESSION_METRICS.set(metrics)
+        writer, _ = make_writer()
+        for edit in range(edits):
+            writer.append(f"Edit {edit}")
+            writer.drain()
+        return metrics
+
+    # Each session runs in its own context, as each connection to the
+    # session server runs in its own task.
+    one_edit = contextvars.copy_context().run(run_session, 1)
+    three_edits = contextvars.copy_context().run(run_session, 3)
+
+    assert batch_update_calls(one_edit) == 1
+    assert batch_update_calls(three_edits) == 3
+    assert SESSION_METRICS.get() is None
@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+from session_server import ERASE, Terminal
+
+
+class TypedReader:
+    """
+    Stands in for a connection's StreamReader, returning each chunk of
+    bytes from its own read, as they would arrive from a browser
+    terminal, and then that the connection has closed
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    async def read(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+class RecordedWriter:
+    """ Stands in for a connection's StreamWriter, keeping what is sent. """
+
+    def __init__(self):
+        self.sent = bytearray()
+
+    def write(self, data):
+        self.sent += data
+
+    async def drain(self):
+        pass
+
+
+def read_lines(*chunks, lines=1):
+    """
+    Types the chunks of bytes into a Terminal, then returns the lines
+    it reads and what it echoes
+    """
+    async def read():
+        writer = RecordedWriter()
+        terminal = Terminal(TypedReader(chunks), writer)
+        read = [await terminal.readline() for _ in range(lines)]
+        return read, writer.sent.decode("utf-8")
+
+    return asyncio.run(read())
+
+
+@pytest.mark.parametrize("ending", [b"\r", b"\n", b"\r\n"])
+def test_line_endings(ending):
+    lines, echoed = read_lines(b"Paris" + ending + b"12" + ending, lines=2)
+
+    assert lines == ["Paris", "12"]
+    assert echoed == "Paris\r\n12\r\n"
+
+
+def test_crlf_split_across_reads():
+    # The line feed of a CRLF may arrive after the line has been read.
+    lines, _ = read_lines(b"one\r", b"\ntwo\r", lines=2)
+
+    assert lines == ["one", "two"]
+
+
+def test_backspace_erases_the_last_character():
+    lines, echoed = read_lines(b"\x7fParx\x7fis\bs\r")
+
+    assert lines == ["Paris"]
+    # Nothing is erased on an empty line.
+    assert echoed == f"Parx{ERASE}is{ERASE}s\r\n"
+
+
+def test_escape_sequences_are_ignored():
+    lines, echoed = read_lines(b"\x1b[A10\x1b[1;5D0\r")
+
+    assert lines == ["100"]
+    assert echoed == "100\r\n"
+
+
+def test_characters_split_across_reads():
+    typed = "£5\r".encode("utf-8")
+    lines, _ = read_lines(typed[:1], typed[1:])
+
+    assert lines == ["£5"]
+
+
+@pytest.mark.parametrize("typed", [b"Par\x03", b"\x04", b"Par"])
+def test_leaving_raises_eof(typed):
+    # Ctrl-C, Ctrl-D on an empty line, or the connection closing.
+    with pytest.raises(EOFError):
+        read_lines(typed)
+
+
+def test_ctrl_d_is_ignored_part_way_through_a_line():
+    lines, _ = read_lines(b"Par\x04is\r")
+
+    assert lines == ["Paris"]
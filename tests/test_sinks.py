@@ -0,0 +1,69 @@
+import pytest
+from sinks import PENDING_DB, PendingUploadSink, SQLiteSink, sync_to_google
+
+
+class RecordedExport:
+    def __init__(self, user_uuid):
+        """ Stands in for a DocumentExport, keeping what is written. """
+        self.user_uuid = user_uuid
+        self.lines = []
+        self.document_id = None
+
+    def append(self, text, section=None):
+        self.lines.append(text)
+
+    def append_table(self, rows, section=None):
+        self.lines.append(rows)
+
+    def close(self):
+        self.document_id = f"document-{self.user_uuid}"
+
+    @property
+    def link(self):
+        return self.document_id
+
+
+def test_only_closed_sessions_are_synced():
+    exports = []
+
+    def make_export(user_uuid):
+        exports.append(RecordedExport(user_uuid))
+        return exports[-1]
+
+    finished = SQLiteSink()
+    finished.append("Taxi: £5.00")
+    finished.append_table([["Category", "Total"], ["Travel", "£5.00"]])
+    finished.close()
+    running = SQLiteSink()
+    running.append("Boat: £10.00")
+
+    assert sync_to_google(make_export) == [
+        (finished.user_uuid, f"document-{finished.user_uuid}")
+    ]
+    assert exports[0].lines == [
+        "Taxi: £5.00", [["Category", "Total"], ["Travel", "£5.00"]]
+    ]
+
+    running.close()
+    assert sync_to_google(make_export) == [
+        (running.user_uuid, f"document-{running.user_uuid}")
+    ]
+    assert sync_to_google(make_export) == []
+
+
+def test_failed_upload_leaves_sessions_for_later():
+    class UnreachableExport(RecordedExport):
+        def close(self):
+            raise ConnectionError("Google APIs are unavailable")
+
+    kept = [PendingUploadSink(), PendingUploadSink()]
+    for sink in kept:
+        sink.append("Taxi: £5.00")
+        sink.close()
+    assert kept[0].link is None
+
+    with pytest.raises(ConnectionError):
+        sync_to_google(UnreachableExport, PENDING_DB)
+    assert [user_uuid for user_uuid, _ in sync_to_google(
+        RecordedExport, PENDING_DB
+    )] == [sink.user_uuid for sink in kept]
@@ -0,0 +1,85 @@
+import datetime
+import json
+import os
+from google.auth import credentials as auth_credentials
+from file_lock import file_lock
+
+
+TOKEN_CACHE_FILE = "token_cache.json"
+
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+"""
+Cached tokens closer than this to expiry are refreshed ahead of time.
+This is longer than google-auth's own refresh threshold, so it never
+treats a token handed out by the cache as expired.
+"""
+
+
+class SharedTokenCredentials(auth_credentials.Credentials):
+    def __init__(self, credentials, path=TOKEN_CACHE_FILE):
+        """
+        Wraps service account credentials so that every session process
+        shares one access token through a file-locked cache on disk,
+        rather than each process exchanging its own with the token
+        endpoint
+        """
+        super().__init__()
+        self.credentials = credentials
+        self.path = path
+        self.key = " ".join(
+            [credentials.service_account_email, *sorted(credentials.scopes)]
+        )
+
+    def load(self):
+        """
+        Returns the cached tokens keyed by account and scopes, or an
+        empty dict if the cache is missing or unreadable
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, cache):
+        """
+        Atomically replaces the cache file, readable only by this user
+        """
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(temp_path, self.path)
+
+    def refresh(self, request):
+        """
+        Takes the shared token from the cache if it is not about to
+        expire, otherwise fetches a new one and stores it for the other
+        processes. A cached token the API has just rejected is never
+        reused.
+        """
+        with file_lock(self.path + ".lock"):
+            cache = self.load()
+            cached = cache.get(self.key)
+            if cached and cached["token"] != self.token:
+                expiry = datetime.datetime.fromisoformat(cached["expiry"])
+                if expiry - REFRESH_MARGIN > utcnow():
+                    self.token = cached["token"]
+                    self.expiry = expiry
+                    return
+            self.credentials.refresh(request)
+            self.token = self.credentials.token
+            self.expiry = self.credentials.expiry
+            cache[self.key] = {
+                "token": self.token,
+                "expiry": self.expiry.isoformat(),
+            }
+            self.save(cache)
+
+
+def utcnow():
+    """
+    Returns the current UTC time as a naive datetime, matching the
+    expiry times google-auth uses
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)